@@ -26,30 +26,56 @@ Requirements:
 
 # Imports for general use
 import argparse
+import BaseHTTPServer
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import httplib
+import json
 import logging
+import multiprocessing
 import os
 import plistlib
+import Queue
+import re
 import sys
 import shutil
+import socket
+import SocketServer
+import sqlite3
 import ssl
 import subprocess
+import threading
+import time
 import traceback
-import urllib2
+import zlib
 
 from collections import namedtuple
+from contextlib import contextmanager
+from cStringIO import StringIO
 from distutils.version import LooseVersion, StrictVersion
 from glob import glob
 from logging.handlers import RotatingFileHandler
-from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
+from urllib import getproxies, proxy_bypass, unquote
+from urlparse import urljoin, urlparse
+from xml.etree import cElementTree
 
 # Imports specifically for FoundationPlist
 # PyLint cannot properly find names inside Cocoa libraries, so issues bogus
 # No name 'Foo' in module 'Bar' warnings. Disable them.
 # pylint: disable=E0611
-from Foundation import NSData  # NOQA
-from Foundation import NSPropertyListSerialization
-from Foundation import NSPropertyListMutableContainers
-from Foundation import NSPropertyListXMLFormat_v1_0  # NOQA
+try:
+    from Foundation import NSData  # NOQA
+    from Foundation import NSPropertyListSerialization
+    from Foundation import NSPropertyListMutableContainers
+    from Foundation import NSPropertyListXMLFormat_v1_0  # NOQA
+except ImportError:
+    # Not on macOS, so plists are read with plistlib, which only handles
+    # XML plists. Loop feeds are XML, so this is enough to download loops.
+    NSData = None
 # pylint: enable=E0611
 
 # Script information
@@ -84,6 +110,8 @@ def readPlist(filepath):
     Read a .plist file from filepath.  Return the unpacked root object
     (which is usually a dictionary).
     """
+    if NSData is None:
+        return plistlib.readPlist(filepath)
     plistData = NSData.dataWithContentsOfFile_(filepath)
     dataObject, dummy_plistFormat, error = (
         NSPropertyListSerialization.
@@ -102,6 +130,8 @@ def readPlist(filepath):
 
 def readPlistFromString(data):
     '''Read a plist data from a string. Return the root object.'''
+    if NSData is None:
+        return plistlib.readPlistFromString(data)
     try:
         plistData = buffer(data)
     except TypeError, err:
@@ -120,43 +150,2157 @@ def readPlistFromString(data):
         return dataObject
 
 
+# Loop feeds
+class FeedReader():
+    '''Streams the Packages dictionary out of an XML loop feed, yielding a
+    (package key, record) tuple per package. Records only hold the keys in
+    FeedReader.fields, and each part of the XML tree is discarded as soon as
+    it has been read, so the whole feed is never held in memory.'''
+    fields = ['DownloadName', 'DownloadSize', 'InstalledSize', 'IsMandatory',
+              'PackageID', 'PackageVersion']
+
+    def __init__(self, source):
+        self.source = source
+        self.config_version = None
+
+    def value(self, elem):
+        '''Returns the Python value of a plist scalar element.'''
+        if elem.tag == 'integer':
+            return int(elem.text)
+        elif elem.tag == 'real':
+            return float(elem.text)
+        elif elem.tag == 'true':
+            return True
+        elif elem.tag == 'false':
+            return False
+
+        # Like plistlib, only use unicode when the text isn't plain ASCII
+        text = elem.text or ''
+        try:
+            return str(text)
+        except UnicodeEncodeError:
+            return text
+
+    def __iter__(self):
+        # Depth 1 is <plist>, 2 the root <dict>, 3 its keys and values,
+        # 4 the package keys and dicts, 5 each package's keys and values.
+        depth = 0
+        parents = {}
+        top_key = None
+        in_packages = False
+        pkg_key = None
+        record = None
+        field = None
+
+        for event, elem in cElementTree.iterparse(self.source, events=('start', 'end')):  # NOQA
+            if event == 'start':
+                depth += 1
+                parents[depth] = elem
+                if depth == 3 and elem.tag != 'key':
+                    in_packages = top_key == 'Packages' and elem.tag == 'dict'  # NOQA
+                elif depth == 4 and in_packages and elem.tag == 'dict':
+                    record = {}
+                continue
+
+            if depth == 3:
+                if elem.tag == 'key':
+                    top_key = elem.text
+                else:
+                    if top_key == 'ConfigVersion':
+                        self.config_version = self.value(elem)
+                    in_packages = False
+                    top_key = None
+                parents[2].clear()
+            elif depth == 4:
+                if not in_packages:
+                    pass
+                elif elem.tag == 'key':
+                    pkg_key = elem.text
+                elif record is not None:
+                    yield (pkg_key, record)
+                    record = None
+                parents[3].clear()
+            elif depth == 5 and record is not None:
+                if elem.tag == 'key':
+                    field = elem.text
+                elif field in self.fields:
+                    record[field] = self.value(elem)
+                    field = None
+                else:
+                    field = None
+            depth -= 1
+
+
+def read_feed(data):
+    '''Returns a loop feed as a dictionary with the ConfigVersion, and a
+    Packages dictionary of compact records from FeedReader. Feeds that can't
+    be streamed (such as binary plists) are read with readPlistFromString.'''
+    if not data.startswith('bplist'):
+        try:
+            reader = FeedReader(StringIO(data))
+            packages = dict(reader)
+            return {'ConfigVersion': reader.config_version, 'Packages': packages}  # NOQA
+        except SyntaxError:
+            pass
+
+    feed = readPlistFromString(data)
+    packages = {}
+    for pkg in feed['Packages']:
+        packages[pkg] = dict([(key, feed['Packages'][pkg][key]) for key in FeedReader.fields if key in feed['Packages'][pkg]])  # NOQA
+    return {'ConfigVersion': feed.get('ConfigVersion'), 'Packages': packages}
+
+
 # Requests
+class Response():
+    '''A response returned by Requests.open(). The underlying connection
+    goes back to the pool once the body has been read, or close() is called.'''
+    def __init__(self, request, key, conn, response, url):
+        self.request = request
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.headers = dict(response.getheaders())
+
+    def getcode(self):
+        return self.response.status
+
+    def info(self):
+        return self.headers
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self.response.read()
+        else:
+            data = self.response.read(amt)
+
+        with self.request.lock:
+            self.request.stats['bytes_read'] += len(data)
+
+        if self.response.isclosed():
+            self.close()
+
+        return data
+
+    def close(self):
+        if self.conn:
+            # Only keep the connection if the body was read in full and the
+            # server hasn't asked for the connection to be closed.
+            if self.response.isclosed() and not self.response.will_close:
+                self.request.release(self.key, self.conn)
+            else:
+                self.conn.close()
+            self.conn = None
+
+
 class Requests():
-    '''Simplify url requests'''
-    def __init__(self, allow_insecure=False):
+    '''Simplify url requests. Keeps a per-host pool of persistent HTTP/1.1
+    connections, so repeated requests to the same server don't pay for a new
+    TCP and TLS handshake each time.'''
+    def __init__(self, allow_insecure=False, user_agent=None):
         self.allow_insecure = allow_insecure
         self.timeout = 5
+        self.max_redirects = 5
+        self.user_agent = user_agent
+
+        if self.allow_insecure:
+            self.ssl_context = ssl._create_unverified_context()
+        else:
+            self.ssl_context = ssl.create_default_context()
+
+        # Environment proxy settings, i.e. http_proxy/https_proxy
+        self.proxies = getproxies()
+
+        # Idle connections, keyed by (scheme, host:port)
+        self.pool = {}
+        self.lock = threading.Lock()
+
+        # Counters to confirm connections are being reused
+        self.stats = {
+            'connections_opened': 0,
+            'requests_made': 0,
+            'requests_by_method': {},
+            'bytes_read': 0,
+        }
+
+    def connection(self, key):
+        '''Returns an idle connection from the pool, or a new connection if
+        there isn't one, and a boolean that is True if it was reused.'''
+        with self.lock:
+            if self.pool.get(key):
+                return (self.pool[key].pop(), True)
+
+            self.stats['connections_opened'] += 1
+
+        scheme, netloc = key
+        proxy = self.proxies.get(scheme)
+
+        if proxy and not proxy_bypass(netloc.split(':')[0]):
+            proxy_netloc = urlparse(proxy).netloc
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(proxy_netloc, timeout=self.timeout, context=self.ssl_context)  # NOQA
+                conn.set_tunnel(netloc)
+            else:
+                conn = httplib.HTTPConnection(proxy_netloc, timeout=self.timeout)  # NOQA
+                # Plain http requests to a proxy must use the full URL
+                conn.absolute_urls = True
+        elif scheme == 'https':
+            conn = httplib.HTTPSConnection(netloc, timeout=self.timeout, context=self.ssl_context)  # NOQA
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+        return (conn, False)
+
+    def release(self, key, conn):
+        '''Returns a connection to the pool for reuse.'''
+        with self.lock:
+            self.pool.setdefault(key, []).append(conn)
+
+    def close(self):
+        '''Closes all idle connections.'''
+        with self.lock:
+            for key in self.pool:
+                for conn in self.pool[key]:
+                    conn.close()
+            self.pool = {}
+
+    def send(self, key, url, method, headers):
+        '''Sends a request on a pooled connection and returns the connection
+        and the httplib response.'''
+        conn, reused = self.connection(key)
+
+        # Requests through a plain http proxy must use the full URL
+        if getattr(conn, 'absolute_urls', False):
+            path = url
+        else:
+            parsed = urlparse(url)
+            path = parsed.path or '/'
+            if parsed.query:
+                path = '%s?%s' % (path, parsed.query)
+
+        with self.lock:
+            self.stats['requests_made'] += 1
+            self.stats['requests_by_method'][method] = self.stats['requests_by_method'].get(method, 0) + 1  # NOQA
 
-    def response_code(self, url):
         try:
-            if self.allow_insecure:
-                return urllib2.urlopen(url, timeout=self.timeout, context=ssl._create_unverified_context()).getcode()  # NOQA
+            conn.request(method, path, headers=headers)
+            return (conn, conn.getresponse())
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if reused:
+                # The server closed an idle connection, retry on a new one.
+                return self.send(key, url, method, headers)
+            raise
+
+    def open(self, url, method='GET', headers=None):
+        '''Makes a request, following redirects, and returns a Response.
+        Raises an exception if the server can't be reached.'''
+        request_headers = {}
+        if self.user_agent:
+            request_headers['User-Agent'] = self.user_agent
+        if headers:
+            request_headers.update(headers)
+
+        for redirect in range(self.max_redirects + 1):
+            parsed = urlparse(url)
+            key = (parsed.scheme, parsed.netloc)
+            conn, response = self.send(key, url, method, request_headers)
+            result = Response(self, key, conn, response, url)
+
+            if response.status in [301, 302, 303, 307, 308] and result.headers.get('location'):  # NOQA
+                # Drain the body so the connection can be reused
+                result.read()
+                result.close()
+                url = urljoin(url, result.headers['location'])
+                if response.status == 303:
+                    method = 'GET'
             else:
-                return urllib2.urlopen(url, timeout=self.timeout).getcode()
-        except urllib2.HTTPError as e:
-            return e.getcode()
-        except urllib2.URLError as e:
+                return result
+
+        raise httplib.HTTPException('Too many redirects: %s' % url)
+
+    def response_code(self, url):
+        try:
+            response = self.open(url, method='HEAD')
+            response.read()
+            return response.getcode()
+        except Exception as e:
             return e
 
     def get_headers(self, url):
         try:
-            if self.allow_insecure:
-                return dict(urllib2.urlopen(url, timeout=self.timeout, context=ssl._create_unverified_context()).info())  # NOQA
+            response = self.open(url, method='HEAD')
+            response.read()
+            if response.getcode() >= 400:
+                return DownloadError('HTTP Error %s: %s' % (response.getcode(), url), response.getcode())  # NOQA
             else:
-                return dict(urllib2.urlopen(url, timeout=self.timeout).info())
+                return response.info()
         except Exception as e:
             return e
 
     def read_data(self, url):
         try:
-            if self.allow_insecure:
-                return urllib2.urlopen(url, timeout=self.timeout, context=ssl._create_unverified_context()).read()  # NOQA
+            response = self.open(url)
+            data = response.read()
+            if response.getcode() >= 400:
+                return Exception('HTTP Error %s: %s' % (response.getcode(), url))  # NOQA
             else:
-                return urllib2.urlopen(url, timeout=self.timeout).read()
+                return data
         except Exception as e:
             return e
 
 
+# Integrity
+BLOCK_SIZE = 8388608
+# Names the BlockDigest scheme wherever its digests are published
+DIGEST_ALGORITHM = 'sha256-tree-8MiB'
+
+
+class BlockDigest():
+    '''SHA-256 of the SHA-256 digests of each BLOCK_SIZE block of a file.
+    Blocks are hashed as the data arrives, and the segments of a file
+    downloaded at the same time each keep their own BlockDigest, which are
+    combined with combine_digests once every segment has finished.'''
+    def __init__(self):
+        self.blocks = []
+        self.block = hashlib.sha256()
+        self.filled = 0
+
+    def update(self, data):
+        while data:
+            take = BLOCK_SIZE - self.filled
+            if len(data) < take:
+                self.block.update(data)
+                self.filled = self.filled + len(data)
+                return
+            self.block.update(data[:take])
+            self.blocks.append(self.block.digest())
+            self.block = hashlib.sha256()
+            self.filled = 0
+            data = data[take:]
+
+    def digests(self):
+        '''Returns the digest of each block, including a final partial one.'''
+        if self.filled:
+            return self.blocks + [self.block.digest()]
+        return list(self.blocks)
+
+    def hexdigest(self):
+        return combine_digests([self])
+
+
+def combine_digests(block_digests):
+    '''Returns the file digest from BlockDigests of consecutive parts of a
+    file, each starting on a block boundary.'''
+    return hashlib.sha256(''.join([''.join(x.digests()) for x in block_digests])).hexdigest()  # NOQA
+
+
+def hash_range(digest, path, start=0, end=None):
+    '''Adds bytes start to end of the file at path to digest, reading in
+    large sequential blocks.'''
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        while end is None or position < end:
+            if end is None:
+                data = f.read(BLOCK_SIZE)
+            else:
+                data = f.read(min(BLOCK_SIZE, end - position))
+            if not data:
+                break
+            digest.update(data)
+            position = position + len(data)
+    return digest
+
+
+def digest_file(path):
+    '''Returns a tuple of path, its size and its BlockDigest, or None for
+    the size and digest if it can't be read. Used by verify runs in a
+    process pool, so it has to live at module level.'''
+    try:
+        return (path, os.path.getsize(path), hash_range(BlockDigest(), path).hexdigest())  # NOQA
+    except (IOError, OSError):
+        return (path, None, None)
+
+
+# Downloads
+class DownloadError(Exception):
+    """The server returned an error response for a download"""
+    def __init__(self, message, code=None):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class SizeError(DownloadError):
+    """A download finished, but isn't the size that was expected"""
+    pass
+
+
+# Lists the packages in a mirrored lp10_ms3_content_YYYY folder
+MIRROR_INDEX = 'appleLoops_index.plist'
+
+
+class Sources():
+    '''Ranks the servers packages can be downloaded from. Package servers
+    have the same lp10_ms3_content_YYYY folder structure as Apple, caching
+    servers are asked for the Apple URL with ?source=, and Apple's servers
+    are always the last resort.
+
+    Sources are ranked by the latency measured at startup, then by the
+    throughput of their transfers as they complete. A source that can't be
+    reached, stalls, or answers with a server error is marked unhealthy and
+    isn't used again for the rest of the run.
+
+    A package server folder with a MIRROR_INDEX is read once, and packages
+    it doesn't list aren't requested from that server.'''
+    def __init__(self, request, reference_size=8388608):
+        self.request = request
+        # A typical package size, to weigh latency against throughput
+        self.reference_size = reference_size
+        self.sources = []
+        self.apple = self.new_source(None, 'apple')
+        self.lock = threading.Lock()
+        self.index_lock = threading.Lock()
+        self.log = logging.getLogger('appleLoops')
+
+    def new_source(self, url, kind):
+        return {
+            'url': url,
+            'kind': kind,
+            'healthy': True,
+            'latency': None,
+            'throughput': None,
+            'files': 0,
+            'bytes': 0,
+            'failed': 0,
+            # Package index of each folder, None if the folder has none
+            'indexes': {},
+        }
+
+    def add(self, url, kind):
+        '''Adds a package server or caching server to the candidates.'''
+        url = url.rstrip('/')
+        if url not in [x['url'] for x in self.sources]:
+            self.sources.append(self.new_source(url, kind))
+
+    def measure(self):
+        '''Times a HEAD request to every source at the same time. A caching
+        server should answer with a HTTP bad request status code.'''
+        def probe(source):
+            start = time.time()
+            try:
+                response = self.request.open(source['url'], method='HEAD')
+                response.read()
+            except Exception as e:
+                self.failed(source, e)
+                return
+
+            code = response.getcode()
+            if code >= 500 or (source['kind'] == 'caching_server' and code != 400):  # NOQA
+                self.failed(source, 'HTTP Error %s: %s' % (code, source['url']))  # NOQA
+            else:
+                source['latency'] = time.time() - start
+
+        if self.sources:
+            pool = ThreadPool(len(self.sources))
+            try:
+                pool.map(probe, self.sources)
+            finally:
+                pool.close()
+                pool.join()
+
+    def score(self, source):
+        '''Returns the expected seconds to fetch a package of reference_size
+        from source. Until a transfer from it completes, a source is scored
+        on latency alone, so every healthy source gets tried.'''
+        seconds = source['latency'] or 0
+        if source['throughput']:
+            seconds = seconds + self.reference_size / source['throughput']
+        return seconds
+
+    def ranked(self):
+        '''Returns the healthy sources, best first, ending with Apple.'''
+        with self.lock:
+            return sorted([x for x in self.sources if x['healthy']], key=self.score) + [self.apple]  # NOQA
+
+    def url(self, source, url):
+        '''Returns the URL to fetch the Apple package URL url from source.'''
+        if source['kind'] == 'apple':
+            return url
+
+        parsed = urlparse(url)
+        if source['kind'] == 'caching_server':
+            return '%s%s?source=%s' % (source['url'], parsed.path, parsed.netloc)  # NOQA
+        return '%s%s' % (source['url'], parsed.path)
+
+    def candidates(self, url):
+        '''Returns a list of (source, URL) tuples to fetch url from, in rank
+        order, leaving out package servers whose index doesn't list it.'''
+        return [(x, self.url(x, url)) for x in self.ranked() if self.listing(x, url) is not False]  # NOQA
+
+    def listing(self, source, url):
+        '''Returns the index entry of the package at the Apple URL url on
+        package server source, a dict with its size. Returns False if the
+        index doesn't list the package, or None if there is no index.'''
+        if source['kind'] != 'pkg_server':
+            return None
+
+        folder, name = os.path.split(urlparse(url).path)
+        with self.index_lock:
+            if folder not in source['indexes']:
+                source['indexes'][folder] = self.load_index(source, folder)
+        index = source['indexes'][folder]
+
+        if index is None:
+            return None
+        return index.get(name, False)
+
+    def load_index(self, source, folder):
+        '''Fetches the MIRROR_INDEX of folder from package server source, and
+        returns the packages it lists, keyed by name.'''
+        index_url = '%s%s/%s' % (source['url'], folder, MIRROR_INDEX)
+        data = self.request.read_data(index_url)
+        if isinstance(data, Exception):
+            self.log.debug('No package index at %s: %s' % (index_url, data))
+            return None
+
+        try:
+            packages = readPlistFromString(data)['packages']
+            self.log.debug('Package index at %s lists %s packages' % (index_url, len(packages)))  # NOQA
+            return packages
+        except Exception as e:
+            self.log.debug('Unable to read package index at %s: %s' % (index_url, e))  # NOQA
+            return None
+
+    def completed(self, source, size, seconds):
+        '''Records a transfer of size bytes from source that took seconds,
+        weighting the throughput of the source towards recent transfers.'''
+        with self.lock:
+            source['files'] = source['files'] + 1
+            source['bytes'] = source['bytes'] + size
+            if size > 0 and seconds > 0:
+                rate = size / seconds
+                if source['throughput']:
+                    source['throughput'] = 0.7 * source['throughput'] + 0.3 * rate  # NOQA
+                else:
+                    source['throughput'] = rate
+
+    def failed(self, source, error):
+        '''Records a failed request to source. An error response for one
+        package, i.e. a package missing from a package server, only fails
+        over for that package. Anything else marks the source unhealthy.
+        Apple's servers are the last resort, so are never marked unhealthy.'''
+        with self.lock:
+            source['failed'] = source['failed'] + 1
+            if source['kind'] == 'apple' or not source['healthy']:
+                return
+            if isinstance(error, DownloadError) and (error.code or 0) < 500:  # NOQA
+                self.log.debug('Falling back from %s: %s' % (source['url'], error))  # NOQA
+                return
+            source['healthy'] = False
+        self.log.info('Package source %s is unhealthy and won\'t be used again this run: %s' % (source['url'], error))  # NOQA
+
+    def summary(self):
+        '''Returns the sources in rank order, unhealthy sources last, for
+        the run report.'''
+        ranked = self.ranked()
+        with self.lock:
+            sources = ranked + [x for x in self.sources if not x['healthy']]
+            return [{
+                'url': x['url'] or 'apple',
+                'kind': x['kind'],
+                'healthy': x['healthy'],
+                'latency_ms': int(x['latency'] * 1000) if x['latency'] is not None else None,  # NOQA
+                'bytes_per_second': int(x['throughput'] or 0),
+                'files': x['files'],
+                'bytes': x['bytes'],
+                'failed': x['failed'],
+                'indexes': len([y for y in x['indexes'].values() if y is not None]),  # NOQA
+            } for x in sources]
+
+
+class Downloads():
+    '''Downloads files over a shared Requests connection pool using a number
+    of worker threads, with a limit on concurrent transfers to any one host.
+    Partial files are resumed with a Range request, like `curl -C -`.
+
+    Files of segment_threshold bytes or more are split into up to segments
+    byte ranges that are fetched at the same time, using any free
+    connections to the host.
+
+    Every transfer is hashed with a BlockDigest as it is written, and checked
+    against the Content-Length and the expected size, so a short or
+    oversized file is never reported as downloaded.
+
+    All transfers draw from limiter, a RateLimiter, if one is given.
+
+    With sources, a Sources, each file is fetched from the best ranked
+    source, failing over to the next as soon as a source errors or stalls
+    for longer than the request timeout.'''
+    def __init__(self, request, workers=4, host_connections=4, retries=3,
+                 segments=4, segment_threshold=67108864, limiter=None,
+                 sources=None):
+        self.request = request
+        self.limiter = limiter
+        self.sources = sources
+        self.workers = workers
+        self.host_connections = host_connections
+        self.retries = retries
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.chunk_size = 1048576
+        # Segment progress is saved after this many bytes or seconds
+        self.checkpoint_bytes = 16777216
+        self.checkpoint_seconds = 5
+        self.log = logging.getLogger('appleLoops')
+
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.host_slots = {}
+        self.lock = threading.Lock()
+
+        # Aggregate transfer stats
+        self.stats = {
+            'files': 0,
+            'bytes': 0,
+            'failed': [],
+            'started': None,
+            'finished': None,
+        }
+
+    def start(self):
+        '''Starts the worker threads if they aren't already running.'''
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.worker)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, url, destination, callback=None, size=None):
+        '''Queues a download. When it finishes, callback is called from the
+        worker thread with the url, destination, the exception raised by the
+        transfer (None if successful) and the digest of the file. size is the
+        expected size of the file in bytes, if known, and decides if the file
+        is segmented.'''
+        self.start()
+        self.queue.put((url, destination, callback, size))
+
+    def join(self):
+        '''Waits until all queued downloads have finished.'''
+        self.queue.join()
+
+    def worker(self):
+        while True:
+            url, destination, callback, size = self.queue.get()
+            try:
+                error = None
+                digest = None
+                try:
+                    digest = self.fetch(url, destination, size)
+                except Exception as e:
+                    error = e
+
+                if callback:
+                    callback(url, destination, error, digest)
+            except Exception as e:
+                self.log.debug('Exception: %s' % e)
+            finally:
+                self.queue.task_done()
+
+    def read_size(self):
+        '''Returns the bytes to read at a time. Reads are smaller while the
+        rate is limited, so throttled transfers are smooth, not bursty.'''
+        if self.limiter:
+            rate = self.limiter.current_rate()
+            if rate:
+                return max(16384, min(self.chunk_size, rate // 8))
+        return self.chunk_size
+
+    def host_slot(self, url):
+        '''Returns the semaphore limiting concurrent transfers to the host.'''
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.host_connections)  # NOQA
+            return self.host_slots[host]
+
+    def fetch(self, url, destination, size=None):
+        '''Downloads url to destination in the calling thread, and returns
+        the digest of the file. A source that fails hands the transfer
+        straight to the next, which resumes it. Failed transfers from the
+        last source are resumed up to self.retries times before giving up.'''
+        with self.lock:
+            if not self.stats['started']:
+                self.stats['started'] = time.time()
+
+        if self.sources:
+            candidates = self.sources.candidates(url)
+        else:
+            candidates = [(None, url)]
+
+        try:
+            for index, (source, source_url) in enumerate(candidates):
+                last = index == len(candidates) - 1
+                if source and not source['healthy'] and not last:
+                    continue
+
+                if os.path.exists(destination):
+                    offset = os.path.getsize(destination)
+                else:
+                    offset = 0
+                start = time.time()
+
+                try:
+                    digest = self.fetch_source(source_url, destination, size, self.retries if last else 0, url)  # NOQA
+                except Exception as e:
+                    if last:
+                        raise
+                    self.sources.failed(source, e)
+                    continue
+
+                if source:
+                    self.sources.completed(source, os.path.getsize(destination) - offset, time.time() - start)  # NOQA
+                with self.lock:
+                    self.stats['files'] += 1
+                return digest
+        except Exception:
+            with self.lock:
+                self.stats['failed'].append(url)
+            raise
+        finally:
+            with self.lock:
+                self.stats['finished'] = time.time()
+
+    def fetch_source(self, url, destination, size, retries, package_url):
+        '''Downloads url to destination, resuming failed transfers up to
+        retries times, and returns the digest of the file. package_url is
+        the Apple URL of the package, which is the same from any source.'''
+        segmented = size and self.segments > 1 and size >= self.segment_threshold  # NOQA
+
+        with self.host_slot(url):
+            for attempt in range(retries + 1):
+                try:
+                    if segmented:
+                        digest = self.segmented(url, destination, size, package_url)  # NOQA
+                        segmented = digest is not None
+                    if not segmented:
+                        digest = self.transfer(url, destination)
+                    break
+                except DownloadError:
+                    # No point retrying an error response
+                    raise
+                except Exception as e:
+                    if attempt == retries:
+                        raise
+                    self.log.debug('Retrying %s after exception: %s' % (url, e))  # NOQA
+
+        # The server finished the transfer, but it isn't the package that
+        # was expected, so don't leave it to be resumed.
+        if size is not None and os.path.getsize(destination) != size:
+            actual = os.path.getsize(destination)
+            os.remove(destination)
+            raise SizeError('Expected %s bytes, received %s: %s' % (size, actual, url))  # NOQA
+
+        return digest
+
+    def transfer(self, url, destination):
+        '''A single attempt at downloading url, appending to destination if a
+        partial file exists and the server honours the Range request. Returns
+        the digest of the file. Only the partial file of a resumed transfer
+        is read back, to hash it before appending.'''
+        try:
+            os.makedirs(os.path.dirname(destination))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        if os.path.exists(destination):
+            offset = os.path.getsize(destination)
+        else:
+            offset = 0
+
+        if offset:
+            headers = {'Range': 'bytes=%s-' % offset}
+            digest = hash_range(BlockDigest(), destination)
+        else:
+            headers = None
+            digest = BlockDigest()
+
+        response = self.request.open(url, headers=headers)
+        try:
+            if response.getcode() == 416:
+                # Nothing left to fetch, the partial file is complete.
+                return digest.hexdigest()
+            elif response.getcode() == 206:
+                mode = 'ab'
+            elif response.getcode() == 200:
+                mode = 'wb'
+                digest = BlockDigest()
+            else:
+                raise DownloadError('HTTP Error %s: %s' % (response.getcode(), url), response.getcode())  # NOQA
+
+            try:
+                length = int(response.info().get('content-length'))
+            except (TypeError, ValueError):
+                length = None
+
+            received = 0
+            with open(destination, mode) as f:
+                while True:
+                    data = response.read(self.read_size())
+                    if not data:
+                        break
+                    if self.limiter:
+                        self.limiter.consume(len(data))
+                    f.write(data)
+                    digest.update(data)
+                    received = received + len(data)
+                    with self.lock:
+                        self.stats['bytes'] += len(data)
+
+            # Retried by fetch, resuming from what was received
+            if length is not None and received < length:
+                raise httplib.IncompleteRead('%s of %s bytes' % (received, length))  # NOQA
+        finally:
+            response.close()
+
+        return digest.hexdigest()
+
+    def ranges_supported(self, url, size):
+        '''Returns True if the server answers a Range request for url with
+        partial content from a file of the expected size.'''
+        response = self.request.open(url, headers={'Range': 'bytes=0-0'})
+        try:
+            # Don't read a whole file from a server that ignored the Range
+            if response.getcode() == 206:
+                response.read()
+        finally:
+            response.close()
+
+        if response.getcode() >= 400 and response.getcode() != 416:
+            raise DownloadError('HTTP Error %s: %s' % (response.getcode(), url), response.getcode())  # NOQA
+
+        return response.getcode() == 206 and response.info().get('content-range', '').endswith('/%s' % size)  # NOQA
+
+    def segmented(self, url, destination, size, package_url=None):
+        '''Downloads url in byte range segments at the same time, writing each
+        in place in destination.part. Progress is kept in a .segments file
+        beside it, so an interrupted download resumes every segment from where
+        it stopped, from any source of package_url. The part file is renamed
+        to destination once complete.
+        Segments start on block boundaries and are hashed as they arrive, and
+        the digest of the file is returned. Returns None, without downloading
+        anything, if the server doesn't honour Range requests.'''
+        part = '%s.part' % destination
+        sidecar = '%s.segments' % part
+
+        try:
+            state = plistlib.readPlist(sidecar)
+            if state['url'] != (package_url or url) or state['size'] != size or not os.path.exists(part):  # NOQA
+                state = None
+        except Exception:
+            state = None
+
+        if state is None:
+            if not self.ranges_supported(url, size):
+                self.log.debug('Range requests not honoured, using a single stream: %s' % url)  # NOQA
+                return None
+
+            try:
+                os.makedirs(os.path.dirname(destination))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            # Each segment is [start, end, next byte to fetch], and is a
+            # whole number of blocks so each can be hashed on its own.
+            length = -(-size // self.segments)
+            length = -(-length // BLOCK_SIZE) * BLOCK_SIZE
+            state = {
+                'url': package_url or url,
+                'size': size,
+                'segments': [[start, min(start + length, size), start] for start in range(0, size, length)],  # NOQA
+            }
+            with open(part, 'wb') as f:
+                f.truncate(size)
+            write_atomic(sidecar, plistlib.writePlistToString(state))
+
+        pending = Queue.Queue()
+        for segment in state['segments']:
+            if segment[2] < segment[1]:
+                pending.put(segment)
+        errors = []
+        digests = {}
+        state_lock = threading.Lock()
+
+        def fetch_segments(slot=None):
+            try:
+                while True:
+                    try:
+                        segment = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        digests[segment[0]] = self.fetch_segment(url, part, segment, state, sidecar, state_lock)  # NOQA
+                    except Exception as e:
+                        errors.append(e)
+                        return
+            finally:
+                if slot:
+                    slot.release()
+
+        # This thread already holds one connection to the host, helpers are
+        # only started for connections that are free right now.
+        slot = self.host_slot(url)
+        helpers = []
+        for x in range(min(self.segments, pending.qsize()) - 1):
+            if not slot.acquire(False):
+                break
+            helper = threading.Thread(target=fetch_segments, args=(slot,))
+            helper.daemon = True
+            helper.start()
+            helpers.append(helper)
+
+        fetch_segments()
+        for helper in helpers:
+            helper.join()
+
+        if errors:
+            raise errors[0]
+
+        if any([segment[2] < segment[1] for segment in state['segments']]):  # NOQA
+            raise DownloadError('Incomplete segmented download: %s' % url)
+
+        # Segments finished by an earlier run are hashed from the part file.
+        # A download started before segments were block aligned is hashed
+        # whole instead.
+        if all([segment[0] % BLOCK_SIZE == 0 for segment in state['segments']]):  # NOQA
+            for segment in state['segments']:
+                if segment[0] not in digests:
+                    digests[segment[0]] = hash_range(BlockDigest(), part, segment[0], segment[1])  # NOQA
+            digest = combine_digests([digests[x] for x in sorted(digests)])
+        else:
+            digest = hash_range(BlockDigest(), part).hexdigest()
+
+        os.rename(part, destination)
+        os.remove(sidecar)
+        return digest
+
+    def checkpoint(self, f, segment, position, state, sidecar, state_lock):  # NOQA
+        '''Syncs the part file to disk, then records position as the progress
+        of segment in the sidecar file, so the sidecar never claims bytes
+        that aren't on disk.'''
+        f.flush()
+        os.fsync(f.fileno())
+        with state_lock:
+            segment[2] = position
+            write_atomic(sidecar, plistlib.writePlistToString(state))
+
+    def fetch_segment(self, url, part, segment, state, sidecar, state_lock):  # NOQA
+        '''Fetches the rest of one segment into the part file, retrying up to
+        self.retries times, and records progress in the sidecar file every
+        checkpoint_bytes or checkpoint_seconds, and when the transfer stops.
+        Returns the BlockDigest of the segment.'''
+        for attempt in range(self.retries + 1):
+            try:
+                # Whatever this segment already holds is read back first
+                digest = hash_range(BlockDigest(), part, segment[0], segment[2])  # NOQA
+                response = self.request.open(url, headers={'Range': 'bytes=%s-%s' % (segment[2], segment[1] - 1)})  # NOQA
+                try:
+                    if response.getcode() != 206:
+                        raise DownloadError('HTTP Error %s for segment of %s' % (response.getcode(), url), response.getcode())  # NOQA
+
+                    with open(part, 'r+b') as f:
+                        f.seek(segment[2])
+                        position = segment[2]
+                        saved = time.time()
+                        try:
+                            while position < segment[1]:
+                                data = response.read(min(self.read_size(), segment[1] - position))  # NOQA
+                                if not data:
+                                    break
+                                if self.limiter:
+                                    self.limiter.consume(len(data))
+                                f.write(data)
+                                digest.update(data)
+                                position = position + len(data)
+                                with self.lock:
+                                    self.stats['bytes'] += len(data)
+
+                                if position - segment[2] >= self.checkpoint_bytes or time.time() - saved >= self.checkpoint_seconds:  # NOQA
+                                    self.checkpoint(f, segment, position, state, sidecar, state_lock)  # NOQA
+                                    saved = time.time()
+                        finally:
+                            # Keep what was received, so a retry resumes
+                            if position > segment[2]:
+                                self.checkpoint(f, segment, position, state, sidecar, state_lock)  # NOQA
+                finally:
+                    response.close()
+
+                if segment[2] < segment[1]:
+                    raise httplib.IncompleteRead('Segment ended early: %s' % url)  # NOQA
+                return digest
+            except DownloadError:
+                raise
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                self.log.debug('Retrying segment of %s after exception: %s' % (url, e))  # NOQA
+
+    def throughput(self):
+        '''Returns the aggregate transfer rate in bytes per second.'''
+        if self.stats['started'] and self.stats['finished'] > self.stats['started']:  # NOQA
+            return self.stats['bytes'] / (self.stats['finished'] - self.stats['started'])  # NOQA
+        else:
+            return 0
+
+
+# Bandwidth
+def parse_rate(value):
+    '''Returns a rate such as 500K, 20M or 1G as bytes per second.'''
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMG]?)B?$', str(value).strip(), re.IGNORECASE)  # NOQA
+    if not match:
+        raise ValueError('%s is not a rate, use a number of bytes per second with an optional K, M or G suffix' % value)  # NOQA
+    return int(float(match.group(1)) * 1024 ** ' KMG'.index(match.group(2).upper() or ' '))  # NOQA
+
+
+def parse_rate_window(value):
+    '''Returns a window such as 22:00-06:00=100M as a tuple of the start and
+    end minute of the day, and the rate in bytes per second. Windows can end
+    at 24:00 or 00:00 for midnight, no later.'''
+    match = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)$', str(value).strip())  # NOQA
+    if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59 or int(match.group(4)) > 59 or int(match.group(3)) * 60 + int(match.group(4)) > 1440:  # NOQA
+        raise ValueError('%s is not a rate window, use HH:MM-HH:MM=rate' % value)  # NOQA
+    return (int(match.group(1)) * 60 + int(match.group(2)),
+            int(match.group(3)) * 60 + int(match.group(4)),
+            parse_rate(match.group(5)))
+
+
+class RateLimiter():
+    '''Token bucket limiting the combined rate of every transfer that draws
+    from it, with at most a second of burst. Windows of the day can set a
+    different rate, for example to download at full speed overnight. A rate
+    of 0 is unlimited.'''
+    def __init__(self, rate=0, windows=None):
+        self.rate = rate
+        self.windows = windows or []
+        self.tokens = 0.0
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        self.stats = {
+            'throttled_seconds': 0.0,
+        }
+
+    def current_rate(self, now=None):
+        '''Returns the rate in bytes per second for the time of day. The first
+        window that covers it wins, windows can run past midnight.'''
+        now = time.localtime(now)
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.windows:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+        return self.rate
+
+    def active(self):
+        return bool(self.rate or [x for x in self.windows if x[2]])
+
+    def consume(self, amount):
+        '''Blocks the calling transfer until amount bytes fit in the rate.
+        Transfers that overdraw the bucket wait for it to refill.'''
+        with self.lock:
+            now = time.time()
+            rate = self.current_rate(now)
+            if not rate:
+                self.tokens = 0.0
+                self.updated = now
+                return
+            self.tokens = min(float(rate), self.tokens + (now - self.updated) * rate) - amount  # NOQA
+            self.updated = now
+            wait = max(0.0, -self.tokens / rate)
+            self.stats['throttled_seconds'] += wait
+        if wait:
+            time.sleep(wait)
+
+
+class Staging():
+    '''Tracks the bytes of packages downloaded ahead of the installer against
+    a budget. At least one package can always be staged, so a package larger
+    than the budget doesn't stall the pipeline.'''
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def reserve(self, size):
+        '''Blocks until there is room in the budget for size bytes.'''
+        with self.condition:
+            while self.used and self.used + size > self.budget:
+                self.condition.wait()
+            self.used = self.used + size
+
+    def release(self, size):
+        with self.condition:
+            self.used = self.used - size
+            self.condition.notify_all()
+
+
+def write_atomic(path, data):
+    '''Writes data to path via a temporary file in the same folder, so other
+    readers never see a partially written file.'''
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+# Configuration
+CONFIG_FILE = 'com.github.carlashley.appleLoops.configuration.plist'
+CACHE_PATHS = [os.path.expanduser('~/Library/Caches/com.github.carlashley.appleLoops'),  # NOQA
+               '/Library/Caches/com.github.carlashley.appleLoops']
+
+
+def cache_folder(cache_path=None, deployment_mode=False):
+    '''Returns the folder for the feed cache, package metadata, sync
+    manifests and state.db: cache_path if given, otherwise the system cache
+    for deployments, or the user's cache.'''
+    if cache_path:
+        return os.path.expanduser(os.path.expandvars(cache_path))
+    elif deployment_mode:
+        return CACHE_PATHS[1]
+    else:
+        return CACHE_PATHS[0]
+
+
+def local_configuration(cache_paths=None):
+    '''Returns a tuple of the path and contents of the first configuration
+    found in the cache folders, alongside this script, or in the current
+    folder. Never touches the network. Returns (None, None) if there is no
+    readable copy.'''
+    paths = [os.path.join(path, CONFIG_FILE) for path in (cache_paths or CACHE_PATHS)]  # NOQA
+    paths.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), CONFIG_FILE))  # NOQA
+    paths.append(CONFIG_FILE)
+
+    for path in paths:
+        try:
+            return (path, plistlib.readPlist(path))
+        except Exception:
+            pass
+    return (None, None)
+
+
+def supported_plists(configuration):
+    '''Returns a sorted list of every loop feed plist in configuration.'''
+    plists = set()
+    for feed in configuration['loop_feeds'].values():
+        plists.update([str(plist) for plist in feed['plists']])
+    return sorted(plists)
+
+
+# Feed cache
+class FeedCache():
+    '''On disk cache of loop feeds. Each feed is stored with the ETag and
+    Last-Modified headers it was served with, so it can be revalidated with
+    a single conditional request, or used as is when the server can't be
+    reached.
+
+    hits counts feeds served from the cache, either revalidated (a 304) or
+    offline (the server couldn't be reached or had an error). changed counts
+    cached feeds the server sent again in full, and misses feeds that
+    weren't cached.'''
+    def __init__(self, path):
+        self.path = path
+        self.log = logging.getLogger('appleLoops')
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'revalidated': 0,
+            'offline': 0,
+            'changed': 0,
+        }
+
+    def files(self, url):
+        '''Returns the paths of the cached feed and its metadata for url.'''
+        name = '%s_%s' % (hashlib.sha1(url).hexdigest()[:12], os.path.basename(urlparse(url).path))  # NOQA
+        return (os.path.join(self.path, name), os.path.join(self.path, '%s.meta' % name))  # NOQA
+
+    def load(self, url):
+        '''Returns a tuple of the cached feed data and its metadata, or
+        (None, {}) if the feed isn't cached.'''
+        data_path, meta_path = self.files(url)
+        try:
+            with open(data_path, 'rb') as f:
+                data = f.read()
+            return (data, plistlib.readPlist(meta_path))
+        except Exception:
+            return (None, {})
+
+    def store(self, url, data, headers):
+        data_path, meta_path = self.files(url)
+        meta = {
+            'url': url,
+            'fetched': int(time.time()),
+        }
+
+        if headers.get('etag'):
+            meta['etag'] = headers['etag']
+
+        if headers.get('last-modified'):
+            meta['last_modified'] = headers['last-modified']
+
+        try:
+            write_atomic(data_path, data)
+            write_atomic(meta_path, plistlib.writePlistToString(meta))
+        except Exception as e:
+            self.log.debug('Unable to cache %s: %s' % (url, e))
+
+    def fetch(self, request, url):
+        '''Returns a tuple of the HTTP status (or exception) and feed data.
+        The data is None unless the status is 200. A cached feed is used if
+        the server says it is unchanged, or can't be reached.'''
+        cached, meta = self.load(url)
+        headers = {'Accept-Encoding': 'gzip'}
+
+        if cached is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = request.open(url, headers=headers)
+            data = response.read()
+            code = response.getcode()
+        except Exception as e:
+            if cached is not None:
+                self.log.info('Unable to reach %s, using cached feed: %s' % (url, e))  # NOQA
+                self.stats['hits'] += 1
+                self.stats['offline'] += 1
+                return (200, cached)
+            return (e, None)
+
+        if code == 304 and cached is not None:
+            self.log.debug('Feed unchanged, using cached copy: %s' % url)
+            self.stats['hits'] += 1
+            self.stats['revalidated'] += 1
+            return (200, cached)
+        elif code == 200:
+            if response.info().get('content-encoding') == 'gzip':
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            if cached is not None:
+                self.stats['changed'] += 1
+            else:
+                self.stats['misses'] += 1
+            self.store(url, data, response.info())
+            return (200, data)
+        elif code >= 500 and cached is not None:
+            self.log.info('Server error %s for %s, using cached feed' % (code, url))  # NOQA
+            self.stats['hits'] += 1
+            self.stats['offline'] += 1
+            return (200, cached)
+        else:
+            return (code, None)
+
+
+# Package metadata cache
+class MetadataCache():
+    '''Persistent cache of package metadata (size, ETag and when it was last
+    verified) keyed by URL. Package URLs are effectively immutable, so sizes
+    are only probed again once an entry is older than ttl seconds.'''
+    def __init__(self, path, ttl=604800, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self.entries = None
+        self.changed = False
+        self.lock = threading.Lock()
+        self.log = logging.getLogger('appleLoops')
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+        }
+
+    def load(self):
+        with self.lock:
+            if self.entries is None:
+                try:
+                    self.entries = plistlib.readPlist(self.path)
+                except Exception:
+                    self.entries = {}
+
+    def get(self, url):
+        '''Returns the cached entry for url, or None if there isn't one, it
+        has expired, or a refresh was asked for.'''
+        self.load()
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry and not self.refresh and time.time() - entry['verified'] < self.ttl:  # NOQA
+                self.stats['hits'] += 1
+                return entry
+            self.stats['misses'] += 1
+            return None
+
+    def peek(self, url):
+        '''Returns the cached entry for url whatever its age, or None.'''
+        self.load()
+        with self.lock:
+            return self.entries.get(url)
+
+    def forget(self, url):
+        '''Removes the entry for url, so it is probed again next time.'''
+        self.load()
+        with self.lock:
+            if self.entries.pop(url, None):
+                self.changed = True
+
+    def set(self, url, size, etag=None):
+        self.load()
+        entry = {
+            'size': size,
+            'verified': int(time.time()),
+        }
+
+        if etag:
+            entry['etag'] = etag
+
+        with self.lock:
+            self.entries[url] = entry
+            self.changed = True
+
+    def save(self):
+        with self.lock:
+            if self.changed:
+                try:
+                    write_atomic(self.path, plistlib.writePlistToString(self.entries))  # NOQA
+                    self.changed = False
+                except Exception as e:
+                    self.log.debug('Unable to save package metadata: %s' % e)  # NOQA
+
+
+# Sync manifest
+class SyncManifest():
+    '''Record of the last successful sync to a destination: the ConfigVersion
+    and package URLs of each feed, and the size, ETag and when the size was
+    last verified of each package.
+    Feeds with the same ConfigVersion as the last sync don't need their
+    packages probed again, and comparing a run with the manifest gives the
+    packages added, changed and removed since.'''
+    def __init__(self, path):
+        self.path = path
+        self.log = logging.getLogger('appleLoops')
+        try:
+            manifest = plistlib.readPlist(self.path)
+        except Exception:
+            manifest = {}
+        self.synced = manifest.get('synced')
+        self.feeds = manifest.get('feeds', {})
+        self.packages = manifest.get('packages', {})
+
+    def unchanged(self, feed, config_version):
+        '''Returns True if feed had the same ConfigVersion at the last sync.'''
+        return config_version is not None and self.feeds.get(feed, {}).get('ConfigVersion') == config_version  # NOQA
+
+    def diff(self, feeds, packages):
+        '''Returns lists of the package URLs added, changed and removed in
+        feeds (a dictionary of feed name to feed record, as saved) since the
+        last sync. packages maps each URL to its size and ETag.'''
+        old_urls = set()
+        new_urls = set()
+        for feed in feeds:
+            old_urls.update(self.feeds.get(feed, {}).get('packages', []))
+            new_urls.update(feeds[feed]['packages'])
+
+        changed = []
+        for url in old_urls & new_urls:
+            old = self.packages.get(url, {})
+            new = packages.get(url, {})
+            if old.get('size') != new.get('size') or (old.get('etag') and new.get('etag') and old['etag'] != new['etag']):  # NOQA
+                changed.append(url)
+
+        return (sorted(new_urls - old_urls), sorted(changed), sorted(old_urls - new_urls))  # NOQA
+
+    def save(self, feeds, packages):
+        '''Records a successful sync of feeds. Feeds that weren't part of this
+        sync keep their previous record.'''
+        self.feeds.update(feeds)
+        self.packages.update(packages)
+
+        # Drop packages that no feed refers to any more
+        urls = set()
+        for feed in self.feeds.values():
+            urls.update(feed['packages'])
+        self.packages = dict([(url, self.packages[url]) for url in urls if url in self.packages])  # NOQA
+        self.synced = int(time.time())
+
+        try:
+            write_atomic(self.path, plistlib.writePlistToString({
+                'synced': self.synced,
+                'feeds': self.feeds,
+                'packages': self.packages,
+            }))
+        except Exception as e:
+            self.log.debug('Unable to save sync manifest: %s' % e)
+
+
+# Download state
+class StateDB():
+    '''SQLite record of every package downloaded: its path, expected size,
+    verified size, source URL, and when the download started and completed.
+    A package is only complete once its download has finished and the file
+    was verified to be the expected size, so interrupted downloads can be
+    told apart from finished ones, and resumed, without fetching anything.
+    Duplicates are found with an indexed lookup by name and size. The digest
+    of each file, taken as it downloaded, is kept for verify runs.'''
+    schema = '''
+        CREATE TABLE IF NOT EXISTS packages (
+            path TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            url TEXT,
+            expected_size INTEGER,
+            verified_size INTEGER,
+            digest TEXT,
+            started INTEGER,
+            completed INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS packages_name_size
+            ON packages (name, verified_size);
+        CREATE INDEX IF NOT EXISTS packages_completed
+            ON packages (completed);
+    '''
+    columns = ['path', 'name', 'url', 'expected_size', 'verified_size',
+               'digest', 'started', 'completed']
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.db = None
+        self.select = ', '.join(self.columns)
+        self.lock = threading.Lock()
+
+    def connect(self):
+        '''Opens the database, creating it if needed. The connection is
+        shared by the download worker threads, guarded by self.lock. A read
+        only database is opened as it is, and nothing is written to it.'''
+        if self.db is None and self.read_only:
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)  # NOQA
+            self.db.text_factory = str
+
+            # Databases from before digests were kept
+            if 'digest' not in [x[1] for x in self.db.execute('PRAGMA table_info(packages)')]:  # NOQA
+                self.select = ', '.join([x if x != 'digest' else 'NULL' for x in self.columns])  # NOQA
+        elif self.db is None:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)  # NOQA
+            self.db.text_factory = str
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(self.schema)
+
+            # Databases from before digests were kept
+            if 'digest' not in [x[1] for x in self.db.execute('PRAGMA table_info(packages)')]:  # NOQA
+                self.db.execute('ALTER TABLE packages ADD COLUMN digest TEXT')
+        return self.db
+
+    def query(self, sql, args=()):
+        with self.lock:
+            rows = self.connect().execute(sql, args).fetchall()
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    def update(self, sql, args=()):
+        with self.lock:
+            db = self.connect()
+            db.execute(sql, args)
+            db.commit()
+
+    def record(self, path):
+        '''Returns the record for path as a dictionary, or None.'''
+        rows = self.query('SELECT %s FROM packages WHERE path = ?' % ', '.join(self.columns), (os.path.abspath(path),))  # NOQA
+        return rows[0] if rows else None
+
+    def digest(self, path):
+        '''Returns the digest recorded for path, or None.'''
+        return (self.record(path) or {}).get('digest')
+
+    def started(self, path, name, url, size):
+        '''Records a download to path starting.'''
+        self.update('INSERT OR REPLACE INTO packages (path, name, url, expected_size, started) VALUES (?, ?, ?, ?, ?)', (os.path.abspath(path), name, url, size, int(time.time())))  # NOQA
+
+    def completed(self, path, name, url, size, digest=None):
+        '''Records path as holding the whole package, verifying its size.'''
+        record = self.record(path) or {}
+        self.update('INSERT OR REPLACE INTO packages (path, name, url, expected_size, verified_size, digest, started, completed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (os.path.abspath(path), name, url, size, os.path.getsize(path), digest, record.get('started'), int(time.time())))  # NOQA
+
+    def find(self, name, size, within=None):
+        '''Returns the path of a complete copy of a package, optionally only
+        one inside the folder within, or None.'''
+        prefix = os.path.join(os.path.abspath(within), '') if within else ''
+        for record in self.query('SELECT %s FROM packages WHERE name = ? AND verified_size = ? AND completed IS NOT NULL ORDER BY completed' % ', '.join(self.columns), (name, size)):  # NOQA
+            if record['path'].startswith(prefix) and os.path.exists(record['path']):  # NOQA
+                return record['path']
+        return None
+
+    def forget(self, path):
+        self.update('DELETE FROM packages WHERE path = ?', (os.path.abspath(path),))  # NOQA
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def incomplete(self):
+        '''Returns the records of downloads that started but didn't finish,
+        oldest first.'''
+        with self.lock:
+            self.connect()
+        return self.query('SELECT %s FROM packages WHERE completed IS NULL ORDER BY started' % self.select)  # NOQA
+
+
+# Installed package receipts
+class ReceiptIndex():
+    '''Index of installed package receipts, mapping package id to version.
+    It is built from a single enumeration of the installed receipts the
+    first time it is queried, so lookups don't spawn a process each.
+
+    command is the enumeration to run, as a list. It must write one receipt
+    per line: the package id, optionally followed by whitespace and the
+    package version. The default `pkgutil --pkgs` only lists ids, so the
+    version of an id listed without one is read from its receipt plist in
+    receipts_path the first time it is asked for, and kept.'''
+    def __init__(self, command=None, receipts_path='/var/db/receipts'):
+        if command:
+            self.command = command
+        else:
+            self.command = ['/usr/sbin/pkgutil', '--pkgs']
+        self.receipts_path = receipts_path
+        self.receipts = None
+        self.lock = threading.Lock()
+        self.log = logging.getLogger('appleLoops')
+        self.stats = {
+            'commands': 0,
+            'receipts_read': 0,
+        }
+
+    def build(self):
+        with self.lock:
+            if self.receipts is None:
+                self.stats['commands'] += 1
+                (result, error) = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
+                receipts = {}
+                for line in result.splitlines():
+                    fields = line.split()
+                    if fields:
+                        if len(fields) > 1:
+                            receipts[fields[0]] = fields[1]
+                        else:
+                            receipts[fields[0]] = None
+                self.receipts = receipts
+                self.log.debug('Indexed %s installed package receipts' % len(self.receipts))  # NOQA
+
+    def read_version(self, pkg_id):
+        '''Returns the version in the receipt plist of pkg_id, or 0.0.0 if
+        it can't be read.'''
+        with self.lock:
+            self.stats['receipts_read'] += 1
+        try:
+            receipt = readPlist(os.path.join(self.receipts_path, '%s.plist' % pkg_id))  # NOQA
+            return str(receipt['PackageVersion'])
+        except Exception as e:
+            self.log.debug('Unable to read receipt for %s: %s' % (pkg_id, e))  # NOQA
+            return '0.0.0'
+
+    def installed(self, pkg_id):
+        '''Returns True if a receipt exists for pkg_id'''
+        self.build()
+        with self.lock:
+            return pkg_id in self.receipts
+
+    def version(self, pkg_id):
+        '''Returns the installed version of pkg_id, or 0.0.0 if the package
+        isn't installed or the version can't be read.'''
+        self.build()
+        with self.lock:
+            version = self.receipts.get(pkg_id, '0.0.0')
+        if version is None:
+            version = self.read_version(pkg_id)
+            with self.lock:
+                self.receipts[pkg_id] = version
+        return version
+
+
+# Free space
+class FreeSpace():
+    '''Tracks free space on the volume holding path. The real value is read
+    with os.statvfs, and only read again once it is older than resample
+    seconds. In between, space is accounted for as work happens:
+
+    reserve() - bytes about to be written (a download or install starting)
+    commit() - reserved bytes that are now written
+    release() - reserved bytes that won't be written after all
+    freed() - bytes of a file that has been deleted'''
+    def __init__(self, path, resample=30):
+        self.path = path
+        self.resample = resample
+        self.free = None
+        self.sampled = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def sample(self):
+        # The target folder may not exist yet, so find the nearest parent.
+        path = os.path.abspath(self.path)
+        while not os.path.exists(path) and path != os.path.dirname(path):
+            path = os.path.dirname(path)
+
+        stat = os.statvfs(path)
+        self.free = stat.f_bavail * stat.f_frsize
+        self.sampled = time.time()
+
+    def available(self):
+        '''Returns free bytes, less any space reserved by work in progress.'''
+        with self.lock:
+            if self.free is None or time.time() - self.sampled > self.resample:  # NOQA
+                self.sample()
+            return self.free - self.pending
+
+    def reserve(self, size):
+        with self.lock:
+            self.pending = self.pending + (size or 0)
+
+    def commit(self, size):
+        with self.lock:
+            self.pending = self.pending - (size or 0)
+            if self.free is not None:
+                self.free = self.free - (size or 0)
+
+    def release(self, size):
+        with self.lock:
+            self.pending = self.pending - (size or 0)
+
+    def freed(self, size):
+        with self.lock:
+            if self.free is not None:
+                self.free = self.free + (size or 0)
+
+
+# Found files
+class FileIndex():
+    '''Index of the .pkg files under a folder, keyed by file name. It is
+    built with a single walk of the folder the first time it is used, and
+    kept up to date with add() as packages land, so lookups cost the same
+    however many files the folder holds.'''
+    def __init__(self, path):
+        self.path = path
+        self.files = None
+        self.lock = threading.Lock()
+
+    def build(self):
+        with self.lock:
+            if self.files is None:
+                files = {}
+                for root, dirs, names in os.walk(self.path, topdown=True):
+                    for name in names:
+                        if name.endswith('.pkg'):
+                            # Sizes are only read when a lookup needs them
+                            files.setdefault(name, {})[os.path.join(root, name)] = None  # NOQA
+                self.files = files
+
+    def add(self, path, size=None):
+        '''Adds a file to the index, with its size if known.'''
+        self.build()
+        with self.lock:
+            self.files.setdefault(os.path.basename(path), {})[path] = size
+
+    def find(self, name, size=None):
+        '''Returns the path of a file called name, or None if there isn't
+        one. If size is given, the file must also be that size.'''
+        self.build()
+        with self.lock:
+            paths = self.files.get(name, {})
+            for path in sorted(paths):
+                if size is None:
+                    return path
+
+                if paths[path] is None:
+                    try:
+                        paths[path] = os.path.getsize(path)
+                    except OSError:
+                        continue
+
+                if paths[path] == size:
+                    return path
+
+        return None
+
+    def __len__(self):
+        self.build()
+        with self.lock:
+            return sum([len(x) for x in self.files.values()])
+
+
+# Package store
+def clone_file(source, destination):
+    '''Makes destination a copy on write clone of source, sharing its blocks
+    until either file changes. Returns False if the filesystem can't clone
+    (for example HFS+ or ext4), or the OS can't (macOS before 10.12 has no
+    clonefile), leaving destination absent.'''
+    if sys.platform == 'darwin':
+        # clonefile(2) on APFS
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            return libc.clonefile(source, destination, 0) == 0
+        except (AttributeError, OSError):
+            return False
+
+    # FICLONE ioctl on Linux, i.e. btrfs or xfs
+    try:
+        with open(source, 'rb') as src:
+            with open(destination, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), 0x40049409, src.fileno())
+        return True
+    except (IOError, OSError):
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
+
+
+class PackageStore():
+    '''A single copy of every package, keyed by package name and size, that
+    the per-plist and mirrored layouts in the destination are materialized
+    from. Files are hard linked out of the store, or cloned if they can't
+    be linked (such as across volumes), and only copied as a last resort.'''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stats = {
+            'hard_link': 0,
+            'clone': 0,
+            'copy': 0,
+        }
+
+    def file(self, name, size):
+        '''Returns the path of a package in the store.'''
+        return os.path.join(self.path, str(size), name)
+
+    def materialize(self, source, destination):
+        '''Makes destination the same file as source, without copying bytes
+        where the filesystem allows. Returns the method used.'''
+        try:
+            os.makedirs(os.path.dirname(destination))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        try:
+            os.link(source, destination)
+            method = 'hard_link'
+        except OSError:
+            if clone_file(source, destination):
+                method = 'clone'
+            else:
+                shutil.copy2(source, destination)
+                method = 'copy'
+
+        with self.lock:
+            self.stats[method] += 1
+        return method
+
+
+class MirrorIndex():
+    '''Keeps the MIRROR_INDEX of each lp10_ms3_content_YYYY folder of a
+    mirror, listing the size, digest and referencing feeds of each package
+    in the folder, so clients can use a package server without probing
+    every package. Digests are BlockDigest values, named by DIGEST_ALGORITHM
+    in each entry, not SHA-256 digests of the whole file. Indexes are kept across runs, and are rewritten
+    atomically as packages land, at most every interval seconds.
+
+    digest is a function that returns the digest of the file at a path, if
+    it is known.'''
+    def __init__(self, digest=None, interval=2):
+        self.digest = digest
+        self.interval = interval
+        # Packages listed in each folder, keyed by name
+        self.indexes = {}
+        # Packages referenced by a feed that haven't landed yet, by path
+        self.pending = {}
+        self.changed = set()
+        self.saved = 0
+        self.lock = threading.Lock()
+        self.log = logging.getLogger('appleLoops')
+        self.stats = {
+            'landed': 0,
+            'writes': 0,
+        }
+
+    def index(self, folder):
+        '''Returns the packages listed in folder, reading its index the first
+        time. Packages no longer in the folder, or that have changed size,
+        are dropped.'''
+        if folder not in self.indexes:
+            try:
+                packages = plistlib.readPlist(os.path.join(folder, MIRROR_INDEX))['packages']  # NOQA
+            except Exception:
+                packages = {}
+
+            for name in packages.keys():
+                path = os.path.join(folder, name)
+                if not os.path.exists(path) or os.path.getsize(path) != packages[name].get('size'):  # NOQA
+                    del packages[name]
+                    self.changed.add(folder)
+                elif 'digest' in packages[name] and 'digest_algorithm' not in packages[name]:  # NOQA
+                    packages[name]['digest_algorithm'] = DIGEST_ALGORITHM
+                    self.changed.add(folder)
+            self.indexes[folder] = packages
+        return self.indexes[folder]
+
+    def reference(self, path, size, feed):
+        '''Records that feed references the package at path, which is size
+        bytes. The package is listed once it lands, straight away if it is
+        already there.'''
+        folder, name = os.path.split(path)
+        with self.lock:
+            entry = self.index(folder).get(name)
+            if entry and entry['size'] == size:
+                if feed not in entry.get('feeds', []):
+                    entry['feeds'] = sorted(entry.get('feeds', []) + [feed])
+                    self.changed.add(folder)
+                return
+
+            pending = self.pending.setdefault(path, {'size': size, 'feeds': []})  # NOQA
+            if feed not in pending['feeds']:
+                pending['feeds'].append(feed)
+
+        if size is not None and os.path.exists(path) and os.path.getsize(path) == size:  # NOQA
+            self.landed(path)
+
+    def landed(self, path, digest=None):
+        '''Lists the package that has landed at path, with its digest.'''
+        folder, name = os.path.split(path)
+        if digest is None and self.digest:
+            digest = self.digest(path)
+
+        with self.lock:
+            pending = self.pending.pop(path, {'size': None, 'feeds': []})
+            packages = self.index(folder)
+            entry = packages.get(name, {'feeds': []})
+            size = pending['size'] if pending['size'] is not None else os.path.getsize(path)  # NOQA
+            if entry.get('size') != size:
+                entry.pop('digest', None)
+                entry.pop('digest_algorithm', None)
+
+            entry['size'] = size
+            entry['feeds'] = sorted(set(entry.get('feeds', []) + pending['feeds']))  # NOQA
+            if digest:
+                entry['digest'] = digest
+                entry['digest_algorithm'] = DIGEST_ALGORITHM
+            packages[name] = entry
+            self.changed.add(folder)
+            self.stats['landed'] += 1
+        self.save()
+
+    def sweep(self):
+        '''Lists any referenced packages that landed without landed() being
+        called, such as copied duplicates and links from the store.'''
+        with self.lock:
+            pending = self.pending.items()
+        for path, entry in pending:
+            if os.path.exists(path) and entry['size'] in [None, os.path.getsize(path)]:  # NOQA
+                self.landed(path)
+
+    def save(self, force=False):
+        '''Writes the index of each folder that has changed, unless one was
+        written less than interval seconds ago.'''
+        with self.lock:
+            if not self.changed or (not force and time.time() - self.saved < self.interval):  # NOQA
+                return
+
+            for folder in self.changed:
+                write_atomic(os.path.join(folder, MIRROR_INDEX), plistlib.writePlistToString({'packages': self.indexes[folder]}))  # NOQA
+                self.stats['writes'] += 1
+                self.log.debug('Package index of %s lists %s packages' % (folder, len(self.indexes[folder])))  # NOQA
+            self.changed = set()
+            self.saved = time.time()
+
+
+# Run report
+class RunReport():
+    '''Phase timers and counters for a run. Time spent inside phase() is
+    added to that phase, and count() adds to a named counter in a group,
+    such as the binaries run by subprocess. Both are safe to use from
+    worker threads.'''
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                phase = self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0})  # NOQA
+                phase['seconds'] = phase['seconds'] + elapsed
+                phase['calls'] = phase['calls'] + 1
+
+    def count(self, group, name, amount=1):
+        with self.lock:
+            counters = self.counters.setdefault(group, {})
+            counters[name] = counters.get(name, 0) + amount
+
+    def build(self, **sections):
+        '''Returns the report as a dictionary, with any extra sections (for
+        example the stats of each cache) added as they are.'''
+        finished = time.time()
+        with self.lock:
+            report = {
+                'version': __version__,
+                'started': int(self.started),
+                'finished': int(finished),
+                'wall_seconds': round(finished - self.started, 3),
+                'phases': dict([(name, {'seconds': round(phase['seconds'], 3), 'calls': phase['calls']}) for name, phase in self.phases.items()]),  # NOQA
+                'counters': dict([(group, dict(counters)) for group, counters in self.counters.items()]),  # NOQA
+            }
+        report.update(sections)
+        return report
+
+    def write(self, path, **sections):
+        '''Writes the report to path as JSON.'''
+        write_atomic(path, json.dumps(self.build(**sections), indent=2, separators=(',', ': '), sort_keys=True))  # NOQA
+
+
+def convert_size(file_size, precision=2):
+    '''Converts a file size in bytes into a human readable number.'''
+    try:
+        suffixes = ['B', 'KB', 'MB', 'GB', 'TB']
+        suffix_index = 0
+        while file_size > 1024 and suffix_index < 4:
+            suffix_index += 1
+            file_size = file_size / 1024.0
+
+        return '%.*f %s' % (precision, file_size, suffixes[suffix_index])  # NOQA
+    except Exception:
+        # Yes, an exception can occur, but ignore it
+        pass
+
+
+# Serving a mirror
+def libc_sendfile():
+    '''Returns sendfile(2) from libc with its arguments set for this
+    platform, or None if it isn't available.'''
+    try:
+        sendfile = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).sendfile  # NOQA
+    except (OSError, AttributeError):
+        return None
+
+    if sys.platform == 'darwin':
+        # int sendfile(int fd, int s, off_t offset, off_t *len, struct sf_hdtr *hdtr, int flags)  # NOQA
+        sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.POINTER(ctypes.c_int64), ctypes.c_void_p, ctypes.c_int]  # NOQA
+        sendfile.restype = ctypes.c_int
+    elif sys.platform.startswith('linux'):
+        # ssize_t sendfile(int out_fd, int in_fd, off_t *offset, size_t count)  # NOQA
+        sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]  # NOQA
+        sendfile.restype = ctypes.c_ssize_t
+    else:
+        return None
+    return sendfile
+
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves files from the mirror, with persistent connections and single
+    byte range requests, so clients can resume like `curl -C -`.'''
+    protocol_version = 'HTTP/1.1'
+    server_version = 'appleLoops/%s' % __version__
+
+    def log_message(self, format, *args):
+        self.server.log.debug('%s - %s' % (self.client_address[0], format % args))  # NOQA
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def respond(self, body):
+        path = self.server.resolve(self.path)
+        if not path:
+            self.send_error(404)
+            return
+
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = '"%x-%x"' % (int(stat.st_mtime), size)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        status = 200
+        match = re.match(r'^bytes=(\d*)-(\d*)$', self.headers.get('Range', '').strip())  # NOQA
+        if match and (match.group(1) or match.group(2)):
+            if not match.group(1):
+                # The last n bytes
+                start = max(0, size - int(match.group(2)))
+            else:
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(int(match.group(2)), size - 1)
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%s' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, size))  # NOQA
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(stat.st_mtime))  # NOQA
+        self.end_headers()
+        if not body:
+            return
+
+        began = time.time()
+        sent = 0
+        try:
+            self.wfile.flush()
+            with open(path, 'rb') as f:
+                sent = self.server.send_file(self.connection, f, start, end - start + 1)  # NOQA
+        except socket.error as e:
+            # The client went away, so don't try to keep the connection
+            self.close_connection = 1
+            self.server.log.debug('Sending %s to %s stopped: %s' % (path, self.client_address[0], e))  # NOQA
+        finally:
+            self.server.transferred(self.client_address[0], path, status, sent, time.time() - began)  # NOQA
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''HTTP server for a --mirror-paths destination, so it can be used as
+    the --pkg-server for deployment runs without a separate web server.
+    Each connection gets a thread, and files are sent with sendfile(2) so
+    their data isn't copied through Python. Throughput is logged for each
+    transfer, and totalled for each client when the server stops.'''
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, root, address=('', 8080), quiet_mode=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MirrorHandler)
+        self.root = os.path.realpath(root)
+        self.quiet_mode = quiet_mode
+        self.sendfile = libc_sendfile()
+        self.log = logging.getLogger('appleLoops')
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.stats = {
+            'sendfile': 0,
+            'copied': 0,
+        }
+
+    def resolve(self, url_path):
+        '''Returns the file in the mirror for a request path, or None. Paths
+        outside the mirror, including through symlinks, aren't served.'''
+        path = os.path.realpath(os.path.join(self.root, unquote(urlparse(url_path).path).lstrip('/')))  # NOQA
+        if path.startswith(os.path.join(self.root, '')) and os.path.isfile(path):  # NOQA
+            return path
+        return None
+
+    def send_file(self, sock, f, offset, count):
+        '''Sends count bytes of the open file f, from offset, to the socket.
+        Uses sendfile(2) where it is available, otherwise reads and sends
+        the file in large blocks. Returns the bytes sent.'''
+        sent = 0
+        if self.sendfile:
+            while sent < count:
+                if sys.platform == 'darwin':
+                    length = ctypes.c_int64(count - sent)
+                    result = self.sendfile(f.fileno(), sock.fileno(), offset + sent, ctypes.byref(length), None, 0)  # NOQA
+                    done = length.value
+                else:
+                    position = ctypes.c_int64(offset + sent)
+                    result = done = self.sendfile(sock.fileno(), f.fileno(), ctypes.byref(position), count - sent)  # NOQA
+                if result < 0:
+                    error = ctypes.get_errno()
+                    if error in [errno.EAGAIN, errno.EINTR]:
+                        sent = sent + max(done, 0)
+                        continue
+                    if sent == 0 and error in [errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP]:  # NOQA
+                        # Not supported for this file or socket
+                        break
+                    raise socket.error(error, os.strerror(error))
+                if done == 0:
+                    # The file is shorter than when the headers were sent
+                    raise socket.error(errno.EPIPE, 'File truncated while sending')  # NOQA
+                sent = sent + done
+            if sent == count:
+                with self.lock:
+                    self.stats['sendfile'] += 1
+                return sent
+
+        f.seek(offset + sent)
+        while sent < count:
+            data = f.read(min(BLOCK_SIZE, count - sent))
+            if not data:
+                raise socket.error(errno.EPIPE, 'File truncated while sending')  # NOQA
+            sock.sendall(data)
+            sent = sent + len(data)
+        with self.lock:
+            self.stats['copied'] += 1
+        return sent
+
+    def transferred(self, client, path, status, sent, seconds):
+        '''Logs a finished transfer and adds it to the client's totals.'''
+        with self.lock:
+            totals = self.clients.setdefault(client, {'requests': 0, 'bytes': 0, 'seconds': 0.0})  # NOQA
+            totals['requests'] += 1
+            totals['bytes'] += sent
+            totals['seconds'] += seconds
+
+        message = '%s %s %s: %s in %.2fs (%s/s)' % (client, status, os.path.relpath(path, self.root), convert_size(sent), seconds, convert_size(sent / max(seconds, 0.001)))  # NOQA
+        if not self.quiet_mode:
+            print message
+        self.log.info(message)
+
+    def run(self):
+        '''Serves until interrupted, then logs the totals for each client.'''
+        message = 'Serving %s on port %s (%s)' % (self.root, self.server_address[1], 'sendfile' if self.sendfile else 'read and send')  # NOQA
+        if not self.quiet_mode:
+            print message
+        self.log.info(message)
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+
+        for client, totals in sorted(self.clients.items()):
+            message = '%s: %s requests, %s at %s/s' % (client, totals['requests'], convert_size(totals['bytes']), convert_size(totals['bytes'] / max(totals['seconds'], 0.001)))  # NOQA
+            if not self.quiet_mode:
+                print message
+            self.log.info(message)
+
+
 # AppleLoops
 class AppleLoops():
     '''
@@ -168,7 +2312,7 @@ class AppleLoops():
         apps_plist: A list, values should be a specific plist to process, i.e. garageband1020.plist  # NOQA
                    These plists are found in the apps Contents/Resources folder. A local copy is kept  # NOQA
                    in case the app can't reach the remote equivalent hosted by Apple.  # NOQA
-        caching_server: A URL string to the caching server on your network.
+        caching_server: A URL string, or a list of them, to caching servers on your network.  # NOQA
                         Must be formatted: http://example.org:45698
         destination: A string, path to save packages in, and create a DMG in (if specified).  # NOQA
                      For example: '/Users/jappleseed/Desktop/loops'
@@ -181,6 +2325,42 @@ class AppleLoops():
                          Default is False.
         optional_loops: Boolean, processes all optional loops as specified by Apple.  # NOQA
                         Default is False.
+        pkg_server: A URL string, or a list of them, to servers with the lp10_ms3_content_YYYY  # NOQA
+                    folders, or 'munki' to use the munki SoftwareRepoURL. Packages are only  # NOQA
+                    downloaded from these in deployment mode. Package and caching servers are  # NOQA
+                    ranked by latency and throughput, with Apple's servers as the last resort.  # NOQA
+        probe_workers: Integer, number of concurrent package size/mirror probes.  # NOQA
+                       Default is 8.
+        download_workers: Integer, number of concurrent package downloads.
+                          Default is 4.
+        host_connections: Integer, maximum concurrent downloads from any one server.  # NOQA
+                          Default is 4.
+        download_segments: Integer, number of byte ranges to fetch at once for large packages.  # NOQA
+                           Default is 4. Use 1 to always download with a single stream.  # NOQA
+        segment_threshold: Integer, size in MB at which packages are downloaded in segments.  # NOQA
+                           Default is 64.
+        cache_path: A string, folder to keep cached loop feeds, package metadata, sync manifests  # NOQA
+                    and the download state database (state.db) in.  # NOQA
+                    Defaults to ~/Library/Caches/com.github.carlashley.appleLoops,  # NOQA
+                    or /Library/Caches/com.github.carlashley.appleLoops in deployment mode.  # NOQA
+        metadata_ttl: Integer, days to trust cached package sizes before probing again.  # NOQA
+                      Default is 7.
+        refresh_metadata: Boolean, ignores cached package sizes and probes every package.  # NOQA
+                          Default is False.
+        receipt_command: A list, command that lists installed package receipts, one  # NOQA
+                         'pkgid [version]' per line. Default is pkgutil --pkgs.  # NOQA
+        report_json: A string, path to write the run report (phase timings and counters) to.  # NOQA
+                     Defaults to appleLoops_report.json in the log folder.  # NOQA
+        store_path: A string, folder to keep a single copy of each package in. Packages in  # NOQA
+                    the destination are hard linked (or cloned) from it. Not used in deployment mode.  # NOQA
+        verify: Boolean, hashes packages already downloaded, using a process per core, and  # NOQA
+                downloads any that are short or don't match. Default is False.  # NOQA
+        max_rate: A string or integer, combined download rate limit in bytes per second,  # NOQA
+                  with an optional K, M or G suffix, i.e. 20M. Default is unlimited.  # NOQA
+        rate_windows: A list of strings, HH:MM-HH:MM=rate times of day with a different  # NOQA
+                      rate limit, i.e. 18:00-07:00=0 for unlimited overnight.  # NOQA
+        order: A string, order packages are downloaded in after mandatory before optional;  # NOQA
+               smallest, largest, or feed. Default is smallest.
         quiet: Boolean, disables all stdout and stderr.
                Default is False. Replaces JSS mode in older versions.
 
@@ -192,7 +2372,12 @@ class AppleLoops():
                  force_dmg=False, hard_link=False, help_init=False,
                  log_path=False, mandatory_loops=False, mirror_paths=False,
                  muted_download=False, optional_loops=False, pkg_server=False,
-                 quiet_mode=False, space_threshold=5):
+                 probe_workers=8, quiet_mode=False, space_threshold=5,
+                 download_workers=4, host_connections=4, cache_path=None,
+                 metadata_ttl=7, refresh_metadata=False, receipt_command=None,
+                 report_json=None, download_segments=4, segment_threshold=64,
+                 store_path=None, verify=False, max_rate=None, rate_windows=None,  # NOQA
+                 order='smallest'):
 
         # Logging
         if not help_init:
@@ -222,6 +2407,21 @@ class AppleLoops():
                 # Log the version info
                 self.log.info('Version: %s' % __version__)
 
+            # Phase timings and counters, written out at the end of the run
+            self.report = RunReport()
+            if report_json:
+                self.report_json = os.path.expanduser(os.path.expandvars(report_json))  # NOQA
+            else:
+                self.report_json = os.path.join(self.log_path, 'appleLoops_report.json')  # NOQA
+
+            # Cache for loop feeds
+            self.cache_path = cache_folder(cache_path, deployment_mode)
+
+            self.feed_cache = FeedCache(self.cache_path)
+
+            # Cache for package sizes, read before probing any package
+            self.metadata = MetadataCache(os.path.join(self.cache_path, 'package_metadata.plist'), ttl=int(metadata_ttl) * 86400, refresh=refresh_metadata)  # NOQA
+
         # Dry run, yo.
         self.dry_run = dry_run
 
@@ -231,6 +2431,12 @@ class AppleLoops():
         # Mutes the download progress bar
         self.muted_download = muted_download
 
+        # Number of package probes to run at the same time
+        if probe_workers and type(probe_workers) is int and probe_workers > 0:
+            self.probe_workers = probe_workers
+        else:
+            self.probe_workers = 1
+
         # Exit codes for when things go bad
         self.exit_codes = {
             'root': [3, 'Must be root to run in deployment mode.'],
@@ -250,6 +2456,7 @@ class AppleLoops():
             'not_all_loops_installed': [17, 'Not all loops installed: ####'],  # NOQA
             'general_exception': [18, 'Exception: ####'],
             'remove_dmg': [19, 'Could not remove file ####'],
+            'rate_format': [20, '####'],
         }
 
         # If deployment mode, and not a dry run, must be root to install loops.
@@ -267,6 +2474,9 @@ class AppleLoops():
         # Allows the --insecure flag to be used with curl
         self.allow_insecure = allow_insecure
 
+        # Installed package receipts, enumerated once when first needed
+        self.receipts = ReceiptIndex(command=receipt_command)
+
         # Allow install with untrusted certs
         # Default is not to allow pkg installs with untrusted certs
         self.allow_untrusted = allow_untrusted
@@ -274,22 +2484,76 @@ class AppleLoops():
         # Initialise requests
         self.request = Requests(allow_insecure=self.allow_insecure)
 
-        # Setup pkg_server
-        if pkg_server:
+        # Initialise the download engine, sharing connections with requests
+        # Bandwidth shared by all the downloads, optionally by time of day
+        try:
+            self.limiter = RateLimiter(parse_rate(max_rate) if max_rate else 0, [parse_rate_window(x) for x in rate_windows or []])  # NOQA
+        except ValueError as e:
+            self.exit('rate_format', custom_msg=str(e))
+
+        # Package and caching servers to download from, ranked once added
+        self.sources = Sources(self.request)
+
+        self.downloads = Downloads(self.request, workers=max(1, int(download_workers)), host_connections=max(1, int(host_connections)),  # NOQA
+                                   segments=max(1, int(download_segments)), segment_threshold=int(segment_threshold) * 1048576,  # NOQA
+                                   limiter=self.limiter if self.limiter.active() else None,  # NOQA
+                                   sources=self.sources)
+
+        # Downloads are done in worker threads, so guard shared state
+        self.lock = threading.Lock()
+
+        # Packages currently downloading, keyed by package URL, and any
+        # duplicates to copy/link once those downloads have finished.
+        self.in_flight = {}
+        self.deferred_duplicates = []
+        self.failed_downloads = []
+
+        # Probe results for the run, keyed by package URL
+        self.probed = {}
+
+        # Check packages already downloaded against their size and digest
+        self.verify = verify
+        self.verified = set()
+        # Hashing processes, started on first use and shared by every feed
+        self.verify_pool = None
+
+        # Packages from every feed are downloaded mandatory first, then
+        # optional, each in this order, so the apps are usable sooner.
+        self.order = order
+        self.scheduled = []
+        self.mandatory_scheduled = 0
+        self.mandatory_pending = 0
+        self.mandatory_failed = 0
+        # Mandatory packages downloaded, copied or linked this run
+        self.mandatory_landed = 0
+        self.mandatory_reported = False
+        self.mandatory_condition = threading.Condition(self.lock)
+        self.usable_seconds = None
+
+        # Setup pkg_server, one or a list of them
+        if isinstance(pkg_server, basestring):
+            pkg_server = [pkg_server]
+
+        self.pkg_servers = []
+        for server in pkg_server or []:
             # Don't need a trailing / in this address
-            if any([pkg_server.startswith('http://'), pkg_server.startswith('https://')]):  # NOQA
-                self.pkg_server = pkg_server.rstrip('/')
-            elif pkg_server == 'munki':
+            if any([server.startswith('http://'), server.startswith('https://')]):  # NOQA
+                self.pkg_servers.append(server.rstrip('/'))
+            elif server == 'munki':
                 try:
                     # This is the standard location for the munki client config  # NOQA
-                    self.pkg_server = readPlist('/Library/Preferences/ManagedInstalls.plist')['SoftwareRepoURL']  # NOQA
-                    self.printlog('Found munki ManagedInstalls.plist, using SoftwareRepoURL %s' % self.pkg_server)  # NOQA
+                    server = readPlist('/Library/Preferences/ManagedInstalls.plist')['SoftwareRepoURL']  # NOQA
+                    self.pkg_servers.append(server.rstrip('/'))
+                    self.printlog('Found munki ManagedInstalls.plist, using SoftwareRepoURL %s' % server)  # NOQA
                 except Exception as e:
                     # If we can't find a munki server, fallback to using
                     # Apple's servers.
-                    self.pkg_server = False
                     self.printlog('Falling back to use Apple servers for package downloads.')  # NOQA
                     self.log.debug('Exception: %s' % e)
+
+        # The first package server also hosts the fallback config and feeds
+        if self.pkg_servers:
+            self.pkg_server = self.pkg_servers[0]
         else:
             # If nothing is provided
             self.pkg_server = False
@@ -298,61 +2562,18 @@ class AppleLoops():
 
         # Read in configuration
         self.github_url = 'https://raw.githubusercontent.com/carlashley/appleLoops/master'  # NOQA
-        self.config_file_path = 'com.github.carlashley.appleLoops.configuration.plist'  # NOQA
+        self.config_file_path = CONFIG_FILE
         self.github_config_url = os.path.join(self.github_url, self.config_file_path)  # NOQA
 
-        # Set up an empy self.configuration to fill, and use in catch later.
-        self.configuration = ''
-
-        # If pkg_server is specified, we can try this URL, otherwise fallback
-        # to the github config url.
-        try:
-            # These try statements for the logging avoid exceptions when printing out the help text.  # NOQA
-            try:
-                self.log.debug('Trying specified package server {} for configuration'.format(self.pkg_server))  # NOQA
-            except Exception:
-                pass
-            if self.pkg_server and self.config_url_reachable(os.path.join(self.pkg_server, self.config_file_path)):  # NOQA
-                # Test if the pkg server path is reachable
-                self.config_url = os.path.join(self.pkg_server, self.config_file_path)  # NOQA
-                self.log.debug('Using %s for configuration url' % e)
-                config = self.request.read_data(self.config_url)
-                self.configuration = plistlib.readPlistFromString(config)  # NOQA
-            else:
-                try:
-                    self.log.debug('Trying github server for configuration')  # NOQA
-                except Exception:
-                    pass
-                # Fail to github and test if github is reachable
-                if self.config_url_reachable(self.github_config_url):
-                    self.config_url = self.github_config_url
-                    self.log.debug('Using %s for configuration url' % e)
-                    config = self.request.read_data(self.config_url)
-                    self.configuration = plistlib.readPlistFromString(config)  # NOQA
-        except Exception:
-            try:
-                try:
-                    self.log.debug('Trying for local configuration file')
-                except Exception:
-                    pass
-                # Fail to local copy
-                self.config_url = self.config_file_path
-                self.configuration = plistlib.readPlist(self.config_url)  # NOQA
-            except Exception as e:
-                if not help_init:
-                    self.log.debug('Exception: %s' % e)
-
-        # This is a catch in case self.configuration is left empty.
-        if not self.configuration:
-            try:
-                config = self.request.read_data(self.github_config_url)
-                self.configuration = plistlib.readPlistFromString(config)  # NOQA
-            except Exception as e:
-                self.exit('config_read', custom_msg=self.config_url)
-                try:
-                    self.log.debug('Exception: %s' % e)
-                except Exception:
-                    pass
+        if help_init:
+            # Help output only needs the supported plists, so use a cached
+            # or bundled copy rather than waiting on the network.
+            self.config_url, self.configuration = local_configuration()
+            if not self.configuration:
+                raise IOError('No local copy of %s found' % self.config_file_path)  # NOQA
+        else:
+            with self.report.phase('configuration'):
+                self.configuration = self.load_configuration()
 
         # Supported apps
         self.supported_apps = ['garageband', 'logicpro', 'mainstage']
@@ -388,12 +2609,7 @@ class AppleLoops():
         self.mainstage_loop_plists.sort()
 
         # List of supported plists for help output.
-        self.supported_plists = []
-        self.supported_plists.extend(self.garageband_loop_plists)
-        self.supported_plists.extend(self.logicpro_loop_plists)
-        self.supported_plists.extend(self.mainstage_loop_plists)
-        self.supported_plists = [str(plist) for plist in list(set(self.supported_plists))]  # NOQA
-        self.supported_plists.sort()
+        self.supported_plists = supported_plists(self.configuration)
 
         # Don't need to do a bunch of stuff just for help output.
         if not help_init:
@@ -408,23 +2624,30 @@ class AppleLoops():
             else:
                 self.apps_plist = False
 
-            if caching_server:
-                if caching_server.startswith('http://'):
-                    self.caching_server = caching_server.rstrip('/')
-                    # Test if the caching server provides a valid response
-                    # Set to false if it doesn't
-                    try:
-                        # The caching service should send back a HTTP bad request status code if it exists  # NOQA
-                        if self.request.response_code(self.caching_server) != 400:  # NOQA
-                            self.printlog('Caching server test failed, falling back to Apple servers.')  # NOQA
-                            self.caching_server = False
-                    except Exception:
-                        self.printlog('Caching server test failed, falling back to Apple servers.')  # NOQA
-                        self.caching_server = False
+            if isinstance(caching_server, basestring):
+                caching_server = [caching_server]
+
+            for server in caching_server or []:
+                if server.startswith('http://'):
+                    self.sources.add(server, 'caching_server')
                 else:
                     self.exit('cache_srv_format')
-            else:
-                self.caching_server = False
+
+            # Important note, a pkg_server must have the same
+            # `lp10_ms3_content_YYYY` folder structure. i.e.
+            # http://munki.example.org/munki_repo/lp10_ms3_content_2016/
+            # This can be achieved by using the `--mirror-paths` option when
+            # running appleLoops.py and then copying the resulting folders
+            # to the munki repo.
+            if self.deployment_mode:
+                for server in self.pkg_servers:
+                    self.sources.add(server, 'pkg_server')
+
+            # Rank the sources, and test them before anything is probed
+            self.sources.measure()
+            for source in self.sources.sources:
+                if not source['healthy']:
+                    self.printlog('Package source test failed, not using %s' % source['url'])  # NOQA
 
             if destination:
                 # Expand any vars/user paths
@@ -447,18 +2670,42 @@ class AppleLoops():
             self.quiet_mode = quiet_mode
 
             self.user_agent = '%s/%s' % (self.configuration['user_agent'], __version__)  # NOQA
+            self.request.user_agent = self.user_agent
 
             # Determines if file copy or hard link (to reduce disk usage)
             self.hard_link = hard_link
 
-            # Creating a list of files found in destination
-            self.files_found = []
-            for root, dirs, files in os.walk(self.destination, topdown=True):
-                for name in files:
-                    if name.endswith('.pkg'):
-                        _file = os.path.join(root, name)
-                        if _file not in self.files_found:
-                            self.files_found.append(_file)
+            # Index of files found in destination, built on first use
+            self.files_found = FileIndex(self.destination)
+
+            # Single copy of each package, that the destination is
+            # materialized from once the downloads have finished.
+            if store_path and not self.deployment_mode:
+                self.store = PackageStore(os.path.expanduser(os.path.expandvars(store_path)))  # NOQA
+            else:
+                self.store = None
+            self.store_links = []
+
+            # Manifest of the last successful sync to this destination
+            if self.deployment_mode:
+                self.manifest = None
+            else:
+                self.manifest = SyncManifest(os.path.join(self.cache_path, 'manifest_%s.plist' % hashlib.sha1(os.path.abspath(self.destination)).hexdigest()[:12]))  # NOQA
+            self.synced_feeds = {}
+            self.synced_pkgs = {}
+            self.changed_pkgs = set()
+
+            # Record of downloads started and completed, across runs
+            if self.deployment_mode:
+                self.state = None
+            else:
+                self.state = StateDB(os.path.join(self.cache_path, 'state.db'))  # NOQA
+
+            # Package index of each mirrored folder, for package servers
+            if self.mirror_paths and not self.dry_run and not self.deployment_mode:  # NOQA
+                self.mirror_index = MirrorIndex(self.state.digest)
+            else:
+                self.mirror_index = None
 
             # Named tuple for loops
             self.Loop = namedtuple('Loop', ['pkg_name',
@@ -483,16 +2730,26 @@ class AppleLoops():
                 'available_space': int(0),
             }
 
+            # Free space on the volume packages are downloaded and
+            # installed to. In deployment mode this is the boot volume.
+            if self.deployment_mode:
+                self.free_space = FreeSpace('/')
+            else:
+                self.free_space = FreeSpace(self.destination)
+
+            # Work from a single reading so the threshold values agree
+            space_available = self.space_available()
+
             if space_threshold and type(space_threshold) is int:
                 self.space_threshold = space_threshold
-                self.size_info['reserved_space'] = self.percentage(self.space_threshold, self.space_available())  # NOQA
-                self.size_info['new_available_space'] = (self.space_available() - self.size_info['reserved_space'])  # NOQA
+                self.size_info['reserved_space'] = self.percentage(self.space_threshold, space_available)  # NOQA
+                self.size_info['new_available_space'] = (space_available - self.size_info['reserved_space'])  # NOQA
             else:
                 self.space_threshold = False
-                self.size_info['new_available_space'] = self.space_available()
+                self.size_info['new_available_space'] = space_available
 
             if self.dry_run:
-                self.size_info['available_space'] = self.space_available()
+                self.size_info['available_space'] = space_available
 
         # Maintain a summary of actions taken in deployment mode
         self.deployment_summary = {
@@ -511,21 +2768,78 @@ class AppleLoops():
 
         print error_msg
         self.log.info('sys.exit(%s) - %s' % (exit_code, error_msg))
+        self.exit_status = {'code': exit_code, 'error': error_msg}
         sys.exit(exit_code)
 
     def printlog(self, message):
         print message
         self.log.info(message)
 
-    def config_url_reachable(self, configuration_url):
-        '''Returns True if the configuration file at github or self hosted
-        has HTTP status of 200, or False if anything else.'''
-        if configuration_url.startswith('http') and self.request.response_code(configuration_url) == 200:  # NOQA
-            return True
-        else:
-            return False
+    def load_configuration(self):
+        '''Returns the configuration from the package server (if specified)
+        or github, and keeps a copy in the cache folder for help output and
+        offline runs. Falls back to the cached or bundled copy if neither
+        server can be reached.'''
+        config_urls = []
+        if self.pkg_server:
+            config_urls.append(os.path.join(self.pkg_server, self.config_file_path))  # NOQA
+        config_urls.append(self.github_config_url)
+
+        for config_url in config_urls:
+            self.log.debug('Trying %s for configuration' % config_url)
+            config = self.request.read_data(config_url)
+            try:
+                if isinstance(config, Exception):
+                    raise config
+                configuration = plistlib.readPlistFromString(config)
+            except Exception as e:
+                self.log.debug('Exception: %s' % e)
+                continue
+
+            self.config_url = config_url
+            self.log.debug('Using %s for configuration url' % self.config_url)  # NOQA
+            try:
+                write_atomic(os.path.join(self.cache_path, self.config_file_path), config)  # NOQA
+            except Exception as e:
+                self.log.debug('Unable to cache configuration: %s' % e)
+            return configuration
+
+        self.log.debug('Trying for local configuration file')
+        self.config_url, configuration = local_configuration([self.cache_path])  # NOQA
+        if not configuration:
+            self.exit('config_read', custom_msg=self.github_config_url)
+
+        self.log.debug('Using %s for configuration' % self.config_url)
+        return configuration
 
     def main_processor(self):
+        '''Runs appleLoops, then writes the run report and closes the download
+        state. These happen however the run ends, so a run that exits early
+        with an exit code, or fails with an exception, is reported too, with
+        its exit code. The sync manifest is only saved by a complete run.'''
+        self.exit_status = {'code': 0, 'error': None}
+        try:
+            self.process_run()
+            self.save_manifest()
+        except SystemExit as e:
+            # self.exit() records its message before exiting
+            if self.exit_status['code'] != e.code:
+                self.exit_status = {'code': e.code, 'error': None}
+            raise
+        except BaseException as e:
+            self.exit_status = {'code': 1, 'error': repr(e)}
+            # Let downloads that were already queued finish, unless the run
+            # was interrupted, so the state and report match what is on disk
+            if not isinstance(e, KeyboardInterrupt):
+                try:
+                    self.finish_downloads()
+                except Exception as error:
+                    self.log.debug('Exception: %s' % error)
+            raise
+        finally:
+            self.finish_run()
+
+    def process_run(self):
         # Some feedback to stdout for CLI use
         if not self.quiet_mode:
             if self.mirror_paths:
@@ -540,12 +2854,23 @@ class AppleLoops():
                 else:
                     self.printlog('Dry run - loops download to: %s' % self.destination)  # NOQA
 
-            if self.caching_server:
-                self.printlog('Caching server: %s' % self.caching_server)
+            for source in self.sources.ranked()[:-1]:
+                self.printlog('Package source: %s (%s, %s ms)' % (source['url'], source['kind'].replace('_', ' '), int(source['latency'] * 1000)))  # NOQA
 
             if self.dmg_filename:
                 self.printlog('DMG path: %s' % self.dmg_filename)
 
+            if self.limiter.active():
+                if self.limiter.rate:
+                    self.printlog('Download rate limit: %s/s' % self.convert_size(self.limiter.rate))  # NOQA
+                for start, end, rate in self.limiter.windows:
+                    self.printlog('Download rate limit from %02d:%02d to %02d:%02d: %s' % (start / 60, start % 60, end / 60, end % 60, '%s/s' % self.convert_size(rate) if rate else 'unlimited'))  # NOQA
+
+        if self.state:
+            incomplete = len(self.state.incomplete())
+            if incomplete:
+                self.log.info('%s downloads did not finish on a previous run and will be resumed if still needed' % incomplete)  # NOQA
+
         # If there are local plists, lets get the basenames because
         # this will be useful for munki install runs.
         # This globs the path for the local plist, which is a blunt
@@ -555,21 +2880,23 @@ class AppleLoops():
         # deployment_mode should only be used by itself.
         if self.deployment_mode:
             if not any([self.apps, self.apps_plist]):
+                feed_urls = []
                 for app in self.supported_apps:
-                    try:
-                        # Test if the plist for the app can be found, if not log the app doesn't appear to be installed.  # NOQA
-                        if len(glob(self.configuration['loop_feeds'][app]['app_path'])) > 0:  # NOQA
-                            urls = self.plist_url(app)
-                            self.process_pkgs(self.get_feed(urls.apple, urls.fallback), os.path.basename(urls.apple))  # NOQA
-                        else:
-                            self.printlog('Skipping %s as it does not appear to be installed.' % app)  # NOQA
-                            pass
-                    except Exception as e:
-                        # Any exception raised here is probably a more
-                        # "serious" exception other than an app not installed.
-                        self.log.debug(traceback.format_exc())
-                        self.log.debug('Exception: %s' % e)
-                        raise e
+                    # Test if the plist for the app can be found, if not log the app doesn't appear to be installed.  # NOQA
+                    if len(glob(self.configuration['loop_feeds'][app]['app_path'])) > 0:  # NOQA
+                        urls = self.plist_url(app)
+                        feed_urls.append((urls.apple, urls.fallback))
+                    else:
+                        self.printlog('Skipping %s as it does not appear to be installed.' % app)  # NOQA
+
+                try:
+                    self.process_feeds(feed_urls)
+                except Exception as e:
+                    # Any exception raised here is probably a more
+                    # "serious" exception other than an app not installed.
+                    self.log.debug(traceback.format_exc())
+                    self.log.debug('Exception: %s' % e)
+                    raise e
                 if self.dry_run:
                     print('-' * 15)  # NOQA
                     # If the install size is 0, there's probably nothing to install  # NOQA
@@ -616,43 +2943,103 @@ class AppleLoops():
                 # sys.exit(1)
 
             if not any([self.apps_plist, self.deployment_mode]):
+                feed_urls = []
                 for app in self.apps:
                     if any(app in x for x in self.supported_apps):  # NOQA
                         if 'garageband' in app:
                             for plist in self.garageband_loop_plists:
                                 apple_url = '%s%s/%s' % (self.base_url, self.garageband_loop_year, plist)  # NOQA
                                 fallback_url = '%s%s/%s' % (self.alt_base_url, self.garageband_loop_year, plist)  # NOQA
-                                self.process_pkgs(self.get_feed(apple_url, fallback_url), os.path.basename(apple_url))  # NOQA
+                                feed_urls.append((apple_url, fallback_url))
 
                         if 'logicpro' in app:
                             for plist in self.logicpro_loop_plists:
                                 apple_url = '%s%s/%s' % (self.base_url, self.logicpro_loop_year, plist)  # NOQA
                                 fallback_url = '%s%s/%s' % (self.alt_base_url, self.logicpro_loop_year, plist)  # NOQA
-                                self.process_pkgs(self.get_feed(apple_url, fallback_url), os.path.basename(apple_url))  # NOQA
+                                feed_urls.append((apple_url, fallback_url))
 
                         if 'mainstage' in app:
                             for plist in self.mainstage_loop_plists:
                                 apple_url = '%s%s/%s' % (self.base_url, self.mainstage_loop_year, plist)  # NOQA
                                 fallback_url = '%s%s/%s' % (self.alt_base_url, self.mainstage_loop_year, plist)  # NOQA
-                                self.process_pkgs(self.get_feed(apple_url, fallback_url), os.path.basename(apple_url))  # NOQA
+                                feed_urls.append((apple_url, fallback_url))
+
+                self.process_feeds(feed_urls)
             else:
                 self.exit('plist_deployment_combo')
 
         if self.apps_plist:
             if not any([self.apps, self.deployment_mode]):
+                feed_urls = []
                 for plist in self.apps_plist:
                     # Strip numbers from plist name to get app name
                     app = ''.join(map(lambda c: '' if c in '0123456789' else c, plist.replace('.plist', '')))  # NOQA
                     app_year = self.configuration['loop_feeds'][app]['loop_year']  # NOQA
                     apple_url = '%s%s/%s' % (self.base_url, app_year, plist)
                     fallback_url = '%s%s/%s' % (self.alt_base_url, app_year, plist)  # NOQA
-                    self.process_pkgs(self.get_feed(apple_url, fallback_url), os.path.basename(apple_url))  # NOQA
+                    feed_urls.append((apple_url, fallback_url))
+
+                self.process_feeds(feed_urls)
             else:
                 self.exit('apps_deployment_combo')
 
+        self.finish_downloads()
+
         if self.dmg_filename:
             self.build_dmg(self.dmg_filename)
 
+    def finish_run(self):
+        '''Stops the hashing processes and logs the cache stats, then writes
+        the run report and closes the connections and the download state.'''
+        if self.verify_pool:
+            self.verify_pool.close()
+            self.verify_pool.join()
+            self.verify_pool = None
+
+        self.log.debug('HTTP connections opened: %s, requests made: %s' % (self.request.stats['connections_opened'], self.request.stats['requests_made']))  # NOQA
+        self.log.info('Feed cache: %s hits (%s revalidated, %s offline), %s changed, %s misses' % (self.feed_cache.stats['hits'], self.feed_cache.stats['revalidated'], self.feed_cache.stats['offline'], self.feed_cache.stats['changed'], self.feed_cache.stats['misses']))  # NOQA
+        self.log.info('Package metadata cache: %s hits, %s misses' % (self.metadata.stats['hits'], self.metadata.stats['misses']))  # NOQA
+        self.request.close()
+        self.write_report()
+        if self.state:
+            self.state.close()
+
+    def write_report(self):
+        '''Writes the run report as JSON to self.report_json.'''
+        if self.receipts.stats['commands']:
+            self.report.count('subprocess', os.path.basename(self.receipts.command[0]), self.receipts.stats['commands'])  # NOQA
+
+        try:
+            self.report.write(self.report_json,
+                              http=self.request.stats,
+                              downloads={
+                                  'files': self.downloads.stats['files'],
+                                  'bytes': self.downloads.stats['bytes'],
+                                  'failed': len(self.downloads.stats['failed']),  # NOQA
+                                  'bytes_per_second': int(self.downloads.throughput()),  # NOQA
+                                  'throttled_seconds': round(self.limiter.stats['throttled_seconds'], 3),  # NOQA
+                              },
+                              caches={
+                                  'feeds': self.feed_cache.stats,
+                                  'metadata': self.metadata.stats,
+                                  'receipts': self.receipts.stats,
+                              },
+                              store=self.store.stats if self.store else None,
+                              sources=self.sources.summary(),
+                              mirror_index=self.mirror_index.stats if self.mirror_index else None,  # NOQA
+                              usable={
+                                  'order': self.order,
+                                  'mandatory_packages': self.mandatory_scheduled,  # NOQA
+                                  'mandatory_failed': self.mandatory_failed,
+                                  'mandatory_landed': self.mandatory_landed,
+                                  'seconds': self.usable_seconds,
+                              },
+                              summary=self.deployment_summary,
+                              exit=self.exit_status)
+            self.log.debug('Run report written to %s' % self.report_json)
+        except Exception as e:
+            self.log.info('Unable to write run report to %s: %s' % (self.report_json, e))  # NOQA
+
     # Functions
     def plist_url(self, app):
         '''Returns a namedtuple with the Apple URL and a fallback URL. These URLs are the feed containing the pkg info.'''  # NOQA
@@ -682,16 +3069,16 @@ class AppleLoops():
 
     def get_feed(self, apple_url, fallback_url):
         '''Returns the feed as a dictionary from either the Apple URL or the fallback URL, pending result code.'''  # NOQA
-        # Initalise request, and check for 404's
-        apple_url_request = self.request.response_code(apple_url)
-        fallback_url_request = self.request.response_code(fallback_url)
+        # Conditional request against the feed cache, and check for 404's
+        apple_url_request, data = self.feed_cache.fetch(self.request, apple_url)  # NOQA
         if apple_url_request == 404:
             # Use fallback URL
             self.log.debug('Falling back to alternate feed: %s' % fallback_url)  # NOQA
+            fallback_url_request, data = self.feed_cache.fetch(self.request, fallback_url)  # NOQA
             if fallback_url_request == 200:
                 req = {
                     'app_feed_file': os.path.basename(fallback_url),
-                    'result': readPlistFromString(self.request.read_data(fallback_url))  # NOQA
+                    'result': read_feed(data)
                 }
                 return req
             else:
@@ -701,24 +3088,110 @@ class AppleLoops():
             # Use Apple URL
             req = {
                 'app_feed_file': os.path.basename(apple_url),
-                'result': readPlistFromString(self.request.read_data(apple_url))  # NOQA
+                'result': read_feed(data)
             }
             return req
         else:
             self.log.info('There was a problem trying to reach %s' % apple_url)  # NOQA
             return Exception('There was a problem trying to reach %s' % apple_url)  # NOQA
 
-    def process_pkgs(self, app_feed_dict, app_feed_filename):
-        # Specific part of the app_feed_dict to process
-        loops = []
+    def process_feeds(self, feed_urls):
+        '''Plans and processes a list of (apple_url, fallback_url) tuples.
+        All the feeds are fetched first, so each unique package across every
+        feed is only probed once, then each feed is processed in turn.'''
+        feeds = []
+        for apple_url, fallback_url in feed_urls:
+            with self.report.phase('feeds'):
+                app_feed_dict = self.get_feed(apple_url, fallback_url)
+            if isinstance(app_feed_dict, Exception):
+                self.printlog('Skipping %s: %s' % (os.path.basename(apple_url), app_feed_dict))  # NOQA
+            else:
+                feeds.append((app_feed_dict, os.path.basename(apple_url)))
+
+        pkg_urls = []
+        known_urls = set()
+        changed_urls = set()
+        for app_feed_dict, app_feed_filename in feeds:
+            _pkg_urls = [x[2] for x in self.resolve_pkgs(app_feed_dict)]
+            pkg_urls.extend(_pkg_urls)
+
+            if self.manifest:
+                config_version = app_feed_dict['result'].get('ConfigVersion')  # NOQA
+                self.synced_feeds[app_feed_filename] = {
+                    'ConfigVersion': config_version or '',
+                    'packages': sorted(set(_pkg_urls)),
+                }
+                if self.manifest.unchanged(app_feed_filename, config_version):  # NOQA
+                    known_urls.update(_pkg_urls)
+                else:
+                    changed_urls.update(_pkg_urls)
+
+        # Packages only in feeds that haven't changed since the last sync are
+        # known, so don't need probing again until their size is as old as
+        # the metadata cache allows, or a refresh was asked for.
+        if not self.metadata.refresh:
+            for pkg_url in known_urls - changed_urls:
+                entry = self.manifest.packages.get(pkg_url, {})
+                if pkg_url not in self.probed and entry.get('size') is not None and time.time() - entry.get('verified', 0) < self.metadata.ttl:  # NOQA
+                    self.probed[pkg_url] = (pkg_url, entry['size'])
+
+        self.log.info('Planned %s unique packages from %s package references in %s feeds' % (len(set(pkg_urls)), len(pkg_urls), len(feeds)))  # NOQA
+        self.probe_pkgs(pkg_urls)
+
+        if self.manifest:
+            self.sync_changes([x[1] for x in feeds], pkg_urls)
+
+        for app_feed_dict, app_feed_filename in feeds:
+            self.process_pkgs(app_feed_dict, app_feed_filename)
+
+        self.schedule_pkgs()
+
+    def sync_changes(self, feeds, pkg_urls):
+        '''Compares the probed packages of feeds with the last sync manifest,
+        printing a summary, and marks any changed packages to be replaced.'''
+        for pkg_url in set(pkg_urls):
+            url, size = self.probed[pkg_url]
+            if size is None:
+                continue
+            # The size was last verified by a probe this run, or by
+            # whichever of the metadata cache or last sync saw it latest
+            sources = [x for x in [self.metadata.peek(url), self.manifest.packages.get(pkg_url)] if x and x.get('size') == size]  # NOQA
+            entry = {
+                'size': size,
+                'verified': max([x.get('verified', 0) for x in sources] or [int(time.time())]),  # NOQA
+            }
+            etag = (self.metadata.peek(url) or self.manifest.packages.get(pkg_url) or {}).get('etag')  # NOQA
+            if etag:
+                entry['etag'] = etag
+            self.synced_pkgs[pkg_url] = entry
+
+        if not self.manifest.synced:
+            self.log.info('No previous sync manifest for %s' % self.destination)  # NOQA
+            return
+
+        added, changed, removed = self.manifest.diff(dict([(feed, self.synced_feeds[feed]) for feed in feeds]), self.synced_pkgs)  # NOQA
+        self.changed_pkgs.update(changed)
+
+        self.printlog('Since last sync on %s: %s added, %s changed, %s removed' % (time.strftime('%Y-%m-%d %H:%M', time.localtime(self.manifest.synced)), len(added), len(changed), len(removed)))  # NOQA
+        for label, urls in [('Added', added), ('Changed', changed), ('Removed', removed)]:  # NOQA
+            for url in urls:
+                self.log.debug('%s since last sync: %s' % (label, url))
+
+    def save_manifest(self):
+        '''Records this run in the sync manifest, if it was a complete sync.'''
+        if self.manifest and self.synced_feeds and not self.dry_run and not self.downloads.stats['failed']:  # NOQA
+            self.manifest.save(self.synced_feeds, self.synced_pkgs)
+
+    def resolve_pkgs(self, app_feed_dict):
+        '''Returns a list of (package key, package name, download URL,
+        destination folder year) tuples for the packages in a feed.'''
         packages = app_feed_dict['result']['Packages']
 
-        # Values to put in the Loop named tuple - lambda strips numbers from name  # NOQA
+        # Lambda strips numbers from name
         _pkg_loop_for = ''.join(map(lambda c: '' if c in '0123456789' else c, os.path.splitext(app_feed_dict['app_feed_file'])[0]))  # NOQA
-        _pkg_plist = app_feed_dict['app_feed_file']
-
         _pkg_year = self.configuration['loop_feeds'][_pkg_loop_for]['loop_year']  # NOQA
 
+        pkgs = []
         for pkg in packages:
             _pkg_name = packages[pkg]['DownloadName']
             _pkg_url = '%s%s/%s' % (self.base_url, _pkg_year, _pkg_name)
@@ -730,33 +3203,38 @@ class AppleLoops():
                 if '2013' in _pkg_name and self.mirror_paths:
                     _pkg_destination_folder_year = '2013'
 
-                _pkg_url = 'https://audiocontentdownload.apple.com/%s' % _pkg_name[3:]  # NOQA
+                _pkg_url = urljoin('%s%s/' % (self.base_url, _pkg_year), _pkg_name)  # NOQA
                 _pkg_name = os.path.basename(_pkg_name)
 
-            # Reformat URL if caching server specified
-            if self.caching_server:
-                self.log.debug(_pkg_url)
-                _pkg_url = urlparse(_pkg_url)
-                _pkg_url = '%s%s?source=%s' % (self.caching_server, _pkg_url.path, _pkg_url.netloc)  # NOQA
+            pkgs.append((pkg, _pkg_name, _pkg_url, _pkg_destination_folder_year))  # NOQA
 
-            # If pkg_server is true, and deployment_mode has a list, use that
-            # instead of Apple servers. Important note, the pkg_server must
-            # have the same `lp10_ms3_content_YYYY` folder structure. i.e.
-            # http://munki.example.org/munki_repo/lp10_ms3_content_2016/
-            # This can be achieved by using the `--mirror-paths` option when
-            # running appleLoops.py and then copying the resulting folders
-            # to the munki repo.
-            if self.pkg_server and self.deployment_mode:
-                if not self.caching_server:
-                    # Test each package path if pkg_server is provided, fallback if not reachable  # NOQA
-                    try:
-                        mirrored_url = _pkg_url.replace('https://audiocontentdownload.apple.com', self.pkg_server)  # NOQA
-                        if self.request.response_code(mirrored_url) == 200:  # NOQA
-                            _pkg_url = mirrored_url
-                        else:
-                            self.log.debug('Response code seeking %s is %s' % (mirrored_url, self.request.response_code(mirrored_url)))  # NOQA
-                    except Exception as e:
-                        self.log.debug('Exception: %s' % e)
+        return pkgs
+
+    def process_pkgs(self, app_feed_dict, app_feed_filename):
+        # Specific part of the app_feed_dict to process
+        loops = []
+        packages = app_feed_dict['result']['Packages']
+
+        # Values to put in the Loop named tuple - lambda strips numbers from name  # NOQA
+        _pkg_loop_for = ''.join(map(lambda c: '' if c in '0123456789' else c, os.path.splitext(app_feed_dict['app_feed_file'])[0]))  # NOQA
+        _pkg_plist = app_feed_dict['app_feed_file']
+
+        _pkg_year = self.configuration['loop_feeds'][_pkg_loop_for]['loop_year']  # NOQA
+
+        # Resolve the download URL for each package first, so the network
+        # probes for size and mirror availability can be run concurrently.
+        pkgs = self.resolve_pkgs(app_feed_dict)
+
+        # Results come back in feed order, one (url, size) tuple per package.
+        probes = self.probe_pkgs([x[2] for x in pkgs])
+
+        for (pkg, _pkg_name, _feed_url, _pkg_destination_folder_year), (_pkg_url, _pkg_size) in zip(pkgs, probes):  # NOQA
+            # Use the size the feed advertises if the server didn't say
+            if _pkg_size is None:
+                try:
+                    _pkg_size = int(packages[pkg]['DownloadSize'])
+                except Exception:
+                    pass
 
             # Mandatory or optional
             try:
@@ -764,13 +3242,6 @@ class AppleLoops():
             except Exception:
                 _pkg_mandatory = False
 
-            # Package size
-            try:
-                # Use int type to avoid exception errors.
-                _pkg_size = int(self.request.get_headers(_pkg_url)['content-length'])  # NOQA
-            except Exception:
-                _pkg_size = None
-
             # Installed size in bytes
             try:
                 # Use int type to avoid exception errors.
@@ -886,121 +3357,332 @@ class AppleLoops():
                     loops.append(loop)
                     self.log.debug(loop)
 
+        # Packages already downloaded are checked before any downloads, so
+        # those that fail are downloaded again.
+        if self.verify and not self.deployment_mode:
+            with self.report.phase('verify'):
+                self.verify_pkgs([x for x in loops if (self.mandatory_loops and x.pkg_mandatory) or (self.optional_loops and not x.pkg_mandatory)])  # NOQA
+
         # Internal method to check if download/download+install takes place
         def download_or_install(loop_pkg):
             '''Internal function to download/install depending on arguments'''  # NOQA
+            # Packages are scheduled once every feed has been processed,
+            # with the running install total at the point each was planned.
+            if self.deployment_mode:
+                if not loop_pkg.pkg_installed:
+                    self.scheduled.append((loop_pkg, self.size_info['install_total']))  # NOQA
+                return
+
             if self.space_threshold and not self.dry_run:
                 if self.size_info['install_total'] >= self.size_info['new_available_space']:  # NOQA
                     self.exit('freespace_threshold')
 
-            if self.deployment_mode:
-                if not loop_pkg.pkg_installed:
-                    # Check available space is sufficient to download and install  # NOQA
-                    if sum([loop_pkg.pkg_size, loop_pkg.pkg_install_size]) < self.space_available():  # NOQA
-                        self.download(loop_pkg)
-                        self.install_pkg(loop_pkg)
+            self.scheduled.append((loop_pkg, self.size_info['install_total']))  # NOQA
+
+        def update_pkg_sizes(loop):
+            # Only add download and install size info if
+            # the package is not installed or needs upgrading
+            if not loop.pkg_installed:
+                self.size_info['download_total'] = self.size_info['download_total'] + (loop.pkg_size or 0)  # NOQA
+                self.size_info['install_total'] = self.size_info['install_total'] + loop.pkg_install_size  # NOQA
+
+        # To be able to check if a loop is within threshold/free disk space
+        # iterate over the loops
+        for _loop in loops:
+            # Only care about mandatory or optional, because other arguments are taken care of elsewhere.  # NOQA
+            if any([self.mandatory_loops, self.optional_loops]):
+                # If mandatory argument supplied and loop is mandatory
+                if self.mandatory_loops and _loop.pkg_mandatory:  # NOQA
+                    update_pkg_sizes(_loop)
+                    download_or_install(_loop)
+
+                # If optional argument supplied and loop is optional
+                if self.optional_loops and not _loop.pkg_mandatory:  # NOQA
+                    update_pkg_sizes(_loop)
+                    download_or_install(_loop)
+            else:
+                self.exit('loop_types')
+
+    def schedule_pkgs(self):
+        '''Downloads, and in deployment mode installs, the packages planned
+        from every feed. Mandatory packages go first, then optional, each
+        ordered by self.order: smallest first gets the apps usable soonest,
+        largest first keeps connections busy with long transfers.'''
+        if self.order == 'smallest':
+            scheduled = sorted(self.scheduled, key=lambda x: (not x[0].pkg_mandatory, x[0].pkg_size or 0))  # NOQA
+        elif self.order == 'largest':
+            scheduled = sorted(self.scheduled, key=lambda x: (not x[0].pkg_mandatory, -(x[0].pkg_size or 0)))  # NOQA
+        else:
+            scheduled = sorted(self.scheduled, key=lambda x: not x[0].pkg_mandatory)  # NOQA
+        self.scheduled = []
+        self.mandatory_scheduled = len([x for x in scheduled if x[0].pkg_mandatory])  # NOQA
+
+        if self.deployment_mode and not self.dry_run:
+            # Downloads and installs are pipelined, the running install
+            # totals follow the new order.
+            install_total = self.size_info['install_total'] - sum([x[0].pkg_install_size for x in scheduled])  # NOQA
+            to_install = []
+            for loop_pkg, planned_total in scheduled:
+                install_total = install_total + loop_pkg.pkg_install_size
+                to_install.append((loop_pkg, install_total))
+            if to_install:
+                with self.report.phase('deploy'):
+                    self.deploy_pkgs(to_install)
+            return
+
+        for loop_pkg, install_total in scheduled:
+            if self.deployment_mode:
+                # Check available space is sufficient to download and install  # NOQA
+                if sum([loop_pkg.pkg_size, loop_pkg.pkg_install_size]) < self.space_available():  # NOQA
+                    self.download(loop_pkg)
+                    self.install_pkg(loop_pkg)
+                else:
+                    self.exit('insufficient_freespace')
+            else:
+                self.download(loop_pkg)
+
+    def mandatory_complete(self):
+        '''Records how long the run took to make the mandatory packages
+        usable, and says so, the first time it is called. If none of them
+        were downloaded, copied or linked this run, they were usable before
+        it started, so no time is recorded.'''
+        with self.lock:
+            if self.mandatory_reported or not self.mandatory_scheduled or self.dry_run:  # NOQA
+                return
+            self.mandatory_reported = True
+            if self.mandatory_landed:
+                self.usable_seconds = round(time.time() - self.report.started, 3)  # NOQA
+
+        if not self.quiet_mode:
+            if not self.mandatory_landed and not self.mandatory_failed:
+                self.printlog('Mandatory set already complete: %s packages' % self.mandatory_scheduled)  # NOQA
+            elif not self.mandatory_landed:
+                self.printlog('Mandatory set incomplete: %s of %s packages failed' % (self.mandatory_failed, self.mandatory_scheduled))  # NOQA
+            elif self.mandatory_failed:
+                self.printlog('Mandatory set complete: %s packages after %.1f seconds, %s failed' % (self.mandatory_scheduled, self.usable_seconds, self.mandatory_failed))  # NOQA
+            else:
+                self.printlog('Mandatory set complete: %s packages after %.1f seconds' % (self.mandatory_scheduled, self.usable_seconds))  # NOQA
+
+    def deploy_pkgs(self, to_install):
+        '''Downloads packages ahead of the installer into a staging area that
+        has a byte budget, while the installer works through the packages in
+        order as their downloads complete. to_install is a list of (loop,
+        install total) tuples.'''
+        # Leave enough room for everything queued to be installed
+        budget = self.size_info['new_available_space'] - self.size_info['install_total']  # NOQA
+        staging = Staging(budget)
+        self.log.debug('Staging budget for downloads: %s' % self.convert_size(max(budget, 0)))  # NOQA
+
+        finished = [threading.Event() for x in to_install]
+        errors = [None] * len(to_install)
+
+        def producer():
+            for index, (loop_pkg, install_total) in enumerate(to_install):
+                staging.reserve(loop_pkg.pkg_size or 0)
+
+                def callback(url, destination, error, digest, index=index, size=loop_pkg.pkg_size):  # NOQA
+                    if error:
+                        self.free_space.release(size)
+                    else:
+                        self.free_space.commit(size)
+                    errors[index] = error
+                    finished[index].set()
+
+                if not self.quiet_mode:
+                    download_log_msg = '%s (Package size: %s  Install size: %s)' % (loop_pkg.pkg_name, self.convert_size(loop_pkg.pkg_size), self.convert_size(loop_pkg.pkg_install_size))  # NOQA
+                    if self.force_deploy:
+                        self.printlog('Force downloading: %s' % download_log_msg)  # NOQA
+                    else:
+                        self.printlog('Downloading: %s' % download_log_msg)
+
+                self.free_space.reserve(loop_pkg.pkg_size)
+                self.downloads.submit(loop_pkg.pkg_url, loop_pkg.pkg_destination, callback=callback, size=loop_pkg.pkg_size)  # NOQA
+
+        thread = threading.Thread(target=producer)
+        thread.daemon = True
+        thread.start()
+
+        # The apps are usable once the last mandatory package is installed
+        last_mandatory = max([index for index, (loop_pkg, install_total) in enumerate(to_install) if loop_pkg.pkg_mandatory] or [None])  # NOQA
+
+        for index, (loop_pkg, install_total) in enumerate(to_install):
+            # Wait with a timeout so a KeyboardInterrupt isn't blocked
+            while not finished[index].is_set():
+                finished[index].wait(1)
+
+            if self.space_threshold:
+                if install_total >= self.size_info['new_available_space']:  # NOQA
+                    self.exit('freespace_threshold')
+
+            if errors[index]:
+                self.printlog('Download failed: %s' % loop_pkg.pkg_name)
+                self.log.debug('Exception: %s' % errors[index])
+                if loop_pkg.pkg_name not in self.deployment_summary['failed_installs']:  # NOQA
+                    self.deployment_summary['failed_installs'].append(loop_pkg.pkg_name)  # NOQA
+                try:
+                    os.remove(loop_pkg.pkg_destination)
+                except Exception:
+                    pass
+            else:
+                self.download_complete(loop_pkg)
+                self.landed(loop_pkg)
+
+                # Check available space is sufficient to install
+                if loop_pkg.pkg_install_size < self.space_available():
+                    installs = self.deployment_summary['successful_installs']  # NOQA
+                    self.free_space.reserve(loop_pkg.pkg_install_size)
+                    self.install_pkg(loop_pkg)
+
+                    if self.deployment_summary['successful_installs'] > installs:  # NOQA
+                        self.free_space.commit(loop_pkg.pkg_install_size)
                     else:
-                        self.exit('insufficient_freespace')
+                        self.free_space.release(loop_pkg.pkg_install_size)
+                else:
+                    self.exit('insufficient_freespace')
+
+            # Account for the package being deleted after the install
+            if not os.path.exists(loop_pkg.pkg_destination):
+                self.free_space.freed(loop_pkg.pkg_size)
+
+            staging.release(loop_pkg.pkg_size or 0)
+
+            if loop_pkg.pkg_mandatory and loop_pkg.pkg_name in self.deployment_summary['failed_installs']:  # NOQA
+                self.mandatory_failed = self.mandatory_failed + 1
+            if index == last_mandatory:
+                self.mandatory_complete()
+
+    def probe_pkgs(self, pkg_urls):
+        '''Probes a list of package URLs using a pool of worker threads.
+        Returns a list of (url, size) tuples in the same order as pkg_urls.
+        Each unique URL is only probed once per run.'''
+        unprobed = []
+        for pkg_url in pkg_urls:
+            if pkg_url not in self.probed:
+                # Placeholder so duplicates in pkg_urls are skipped
+                self.probed[pkg_url] = None
+                unprobed.append(pkg_url)
+
+        self.report.count('packages', 'probed', len(unprobed))
+        with self.report.phase('probes'):
+            workers = min(self.probe_workers, len(unprobed))
+
+            if workers > 1:
+                pool = ThreadPool(workers)
+                try:
+                    results = pool.map(self.probe_pkg, unprobed)
+                finally:
+                    pool.close()
+                    pool.join()
             else:
-                # Only download if this isn't a deployment run
-                if not self.deployment_mode:
-                    self.download(loop_pkg)
+                results = [self.probe_pkg(pkg_url) for pkg_url in unprobed]
 
-        def update_pkg_sizes(loop):
-            # Only add download and install size info if
-            # the package is not installed or needs upgrading
-            if not loop.pkg_installed:
-                self.size_info['download_total'] = self.size_info['download_total'] + loop.pkg_size  # NOQA
-                self.size_info['install_total'] = self.size_info['install_total'] + loop.pkg_install_size  # NOQA
+            self.probed.update(zip(unprobed, results))
+            self.metadata.save()
 
-        # To be able to check if a loop is within threshold/free disk space
-        # iterate over the loops
-        for _loop in loops:
-            # Only care about mandatory or optional, because other arguments are taken care of elsewhere.  # NOQA
-            if any([self.mandatory_loops, self.optional_loops]):
-                # If mandatory argument supplied and loop is mandatory
-                if self.mandatory_loops and _loop.pkg_mandatory:  # NOQA
-                    update_pkg_sizes(_loop)
-                    download_or_install(_loop)
+        return [self.probed[pkg_url] for pkg_url in pkg_urls]
 
-                # If optional argument supplied and loop is optional
-                if self.optional_loops and not _loop.pkg_mandatory:  # NOQA
-                    update_pkg_sizes(_loop)
-                    download_or_install(_loop)
-            else:
-                self.exit('loop_types')
+    def probe_pkg(self, pkg_url):
+        '''Returns a tuple of the package URL, and the package size in bytes
+        (None if the size can't be determined). The package metadata cache
+        is checked before any network request, then each package source in
+        rank order until one has the package. A package server with an index
+        is looked up in the index instead. Downloads pick their source when
+        they start, so the URL is always the Apple URL.'''
+        entry = self.metadata.get(pkg_url)
+        if entry:
+            return (pkg_url, entry['size'])
 
-    def space_available(self):
-        cmd = ['/usr/sbin/diskutil', 'info', '-plist', '/']
-        (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
-        # Return an int
-        return int(plistlib.readPlistFromString(result)['FreeSpace'])
+        for source, source_url in self.sources.candidates(pkg_url):
+            if not source['healthy']:
+                continue
 
-    def loop_installed(self, pkg_id):
-        '''Returns if a package is installed'''
-        cmd = ['/usr/sbin/pkgutil', '--pkg-info-plist', pkg_id]
-        (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
-
-        if result:
-            # need to use plistlib as this doesn't cause issues with tests
-            _pkg_id = plistlib.readPlistFromString(result)['pkgid']
-            if pkg_id in _pkg_id:
-                return True
-            else:
-                return False
-        else:
-            return False
+            listed = self.sources.listing(source, pkg_url)
+            if listed and listed.get('size') is not None:
+                return (pkg_url, int(listed['size']))
 
-    def local_version(self, pkg_id):
-        cmd = ['/usr/sbin/pkgutil', '--pkg-info-plist', pkg_id]
-        (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
+            headers = self.request.get_headers(source_url)
+            if isinstance(headers, Exception):
+                self.sources.failed(source, headers)
+                continue
 
-        if result:
+            # Package size
             try:
-                ver = plistlib.readPlistFromString(result)['pkg-version']
+                # Use int type to avoid exception errors.
+                pkg_size = int(headers['content-length'])
+                self.metadata.set(pkg_url, pkg_size, headers.get('etag'))
+                return (pkg_url, pkg_size)
             except Exception:
-                # If the plist can't be read, or throws an exception, the package is probably not installed.  # NOQA
-                ver = '0.0.0'
+                break
 
-        if error:
-            # If there is an error, then the package is probably not installed.
-            # Unlikely to happen, because Apple seems to send stderr to stdout here.  # NOQA
-            ver = '0.0.0'
+        return (pkg_url, None)
+
+    def space_available(self):
+        # Return an int
+        return int(self.free_space.available())
+
+    def loop_installed(self, pkg_id):
+        '''Returns if a package is installed'''
+        with self.report.phase('receipts'):
+            return self.receipts.installed(pkg_id)
 
-        return ver
+    def local_version(self, pkg_id):
+        with self.report.phase('receipts'):
+            return self.receipts.version(pkg_id)
 
     def download(self, pkg):
-        # The mighty power of curl. Using `-L -C - <url>` to resume the download if a file exists.  # NOQA
-        curl = ['/usr/bin/curl']
-        insecure = ['--insecure']
-        silent = ['--silent']
-        progress = ['--progress-bar']
-        common_args = ['-L', '-C', '-', pkg.pkg_url, '--create-dirs', '-o', pkg.pkg_destination, '--user-agent', self.user_agent]  # NOQA
-        download_log_msg = '%s (Package size: %s  Install size: %s)' % (pkg.pkg_name, self.convert_size(int(pkg.pkg_size)), self.convert_size(pkg.pkg_install_size))  # NOQA
-
-        # Create the comand
-        if self.allow_insecure:
-            curl.extend(insecure)
+        '''Queues the package with the download engine, unless it has already
+        been downloaded or can be copied from a duplicate. Deployment mode
+        downloads go through deploy_pkgs instead, except for dry runs.'''
+        download_log_msg = '%s (Package size: %s  Install size: %s)' % (pkg.pkg_name, self.convert_size(int(pkg.pkg_size or 0)), self.convert_size(pkg.pkg_install_size))  # NOQA
 
-        if self.quiet_mode or self.muted_download:
-            silent.extend(common_args)
-            curl.extend(silent)
-        else:
-            progress.extend(common_args)
-            curl.extend(progress)
+        if self.mirror_index:
+            self.mirror_index.reference(pkg.pkg_destination, pkg.pkg_size, pkg.pkg_plist)  # NOQA
 
-        # After extending the curl list, now make it the cmd to be used
-        cmd = curl
+        # The package has changed since the last sync, so replace it, unless
+        # this is the replacement already downloading to the same path.
+        if pkg.pkg_url in self.changed_pkgs and os.path.exists(pkg.pkg_destination) and self.in_flight.get(pkg.pkg_url) != pkg.pkg_destination:  # NOQA
+            if self.dry_run:
+                if not self.quiet_mode:
+                    self.printlog('Update: %s' % download_log_msg)
+                return
+            os.remove(pkg.pkg_destination)
+            self.state.forget(pkg.pkg_destination)
+
+        # A file left by an interrupted download is resumed, and one that
+        # has changed since it was downloaded is replaced.
+        if self.state and os.path.exists(pkg.pkg_destination) and self.in_flight.get(pkg.pkg_url) != pkg.pkg_destination:  # NOQA
+            file_state = self.file_state(pkg.pkg_destination, pkg)
+            if file_state == 'partial':
+                self.in_flight[pkg.pkg_url] = pkg.pkg_destination
+                self.resume(pkg, pkg.pkg_destination, download_log_msg)
+                return
+            elif file_state == 'stale':
+                if self.dry_run:
+                    if not self.quiet_mode:
+                        self.printlog('Update: %s' % download_log_msg)
+                    return
+                os.remove(pkg.pkg_destination)
+                self.state.forget(pkg.pkg_destination)
 
         # Handling duplicates
         if not os.path.exists(pkg.pkg_destination):
-                # Test if there is a duplicate. This also copies duplicates.
+            # The store is keyed by size, so packages of unknown size are
+            # downloaded straight to their destination
+            if self.store and pkg.pkg_size is not None:
+                self.download_to_store(pkg, download_log_msg)
+                return
+
+            # The same package is still being downloaded elsewhere, so copy
+            # or link it once the downloads have finished.
+            if pkg.pkg_url in self.in_flight:
+                self.deferred_duplicates.append((self.in_flight[pkg.pkg_url], pkg))  # NOQA
+                self.report.count('packages', 'duplicates_deferred')
+                return
+
+            # Test if there is a duplicate. This also copies duplicates.
             try:
                 self.duplicate_file_exists(pkg)
             except Exception:  # Exception as e:
-                # Log if the pkg url has fallen back direct to Apple in circumstances  # NOQA
-                if (self.pkg_server and 'audiocontentdownload.apple.com' in pkg.pkg_url) or (self.caching_server and '?source=' not in pkg.pkg_url):  # NOQA
-                    self.log.info('Falling back to Apple server for %s download' % pkg.pkg_name)  # NOQA
                 # Use the exception to kick the download process.
                 if self.dry_run:
                     if not self.quiet_mode:
@@ -1011,9 +3693,7 @@ class AppleLoops():
                                 self.printlog('Download: %s' % download_log_msg)  # NOQA
 
                     # Add this to self.files_found so we can test on the next go around  # NOQA
-                    if self.files_found:
-                        if pkg.pkg_destination not in self.files_found:
-                            self.files_found.append(pkg.pkg_destination)
+                    self.files_found.add(pkg.pkg_destination, pkg.pkg_size)
                 else:
                     if not self.quiet_mode:
                         # Do some quick tests if pkg_server is specified
@@ -1022,21 +3702,286 @@ class AppleLoops():
                         else:
                             self.printlog('Downloading: %s' % download_log_msg)
 
-                    # For some reason this was indented into the above not self.quiet, it shouldn't be  # NOQA
-                    subprocess.check_call(cmd)
-
-                    # Update summary report
-                    self.deployment_summary['downloaded_amount'] = self.deployment_summary['downloaded_amount'] + pkg.pkg_size  # NOQA
-
-                    # Add this to self.files_found so we can test on the next go around  # NOQA
-                    if self.files_found:
-                        if pkg.pkg_destination not in self.files_found:
-                            self.files_found.append(pkg.pkg_destination)
+                    self.in_flight[pkg.pkg_url] = pkg.pkg_destination
+                    self.queue_download(pkg, pkg.pkg_destination)
 
         elif os.path.exists(pkg.pkg_destination):
+            self.report.count('packages', 'skipped')
             if not self.quiet_mode:
                 self.printlog('Skipping %s' % pkg.pkg_name)
 
+    def download_to_store(self, pkg, download_log_msg):
+        '''Queues the package to download into the store, unless it is
+        already there or planned, and records the link to make from the store
+        to the package destination once the downloads have finished.'''
+        store_file = self.store.file(pkg.pkg_name, pkg.pkg_size)
+        self.store_links.append((store_file, pkg))
+
+        # A changed package with the same size replaces the old store copy
+        if pkg.pkg_url in self.changed_pkgs and store_file not in self.in_flight and os.path.exists(store_file) and not self.dry_run:  # NOQA
+            os.remove(store_file)
+            self.state.forget(store_file)
+
+        if store_file not in self.in_flight and os.path.exists(store_file):
+            file_state = self.file_state(store_file, pkg)
+            if file_state == 'partial':
+                self.in_flight[store_file] = pkg.pkg_destination
+                self.resume(pkg, store_file, download_log_msg)
+                return
+            elif file_state == 'stale' and not self.dry_run:
+                os.remove(store_file)
+                self.state.forget(store_file)
+
+        # In store mode, in_flight is keyed by the store file instead
+        if store_file in self.in_flight or os.path.exists(store_file):
+            self.report.count('packages', 'from_store')
+            if self.dry_run and not self.quiet_mode:
+                self.printlog('Link from store: %s' % pkg.pkg_name)
+            return
+        self.in_flight[store_file] = pkg.pkg_destination
+
+        # A copy from a run without the store seeds the store instead
+        source_file = self.files_found.find(pkg.pkg_name, pkg.pkg_size)
+        if source_file:
+            self.report.count('packages', 'from_destination')
+            if self.dry_run:
+                if not self.quiet_mode:
+                    self.printlog('Add existing file to store: %s' % pkg.pkg_name)  # NOQA
+            else:
+                self.store.materialize(source_file, store_file)
+                self.state.completed(store_file, pkg.pkg_name, pkg.pkg_url, pkg.pkg_size, self.state.digest(source_file))  # NOQA
+            return
+
+        if self.dry_run:
+            if not self.quiet_mode:
+                self.printlog('Download: %s' % download_log_msg)
+        else:
+            if not self.quiet_mode:
+                self.printlog('Downloading: %s' % download_log_msg)
+            self.queue_download(pkg, store_file)
+
+    def verify_pkgs(self, loops):
+        '''Hashes the packages already downloaded for loops in a process per
+        core, with one read of each file, and checks them against the
+        expected size and the digest recorded when they were downloaded.
+        Short files are resumed, and files that don't match are removed, so
+        both are downloaded again. Files hard linked to each other are only
+        read once.'''
+        paths = {}
+        for loop in loops:
+            for path in [loop.pkg_destination, self.store.file(loop.pkg_name, loop.pkg_size) if self.store and loop.pkg_size is not None else None]:  # NOQA
+                if path and path not in self.verified and os.path.exists(path):  # NOQA
+                    paths[path] = loop
+        self.verified.update(paths)
+        if not paths:
+            return
+
+        inodes = {}
+        for path in sorted(paths):
+            stat = os.stat(path)
+            inodes.setdefault((stat.st_dev, stat.st_ino), []).append(path)
+        links = dict([(x[0], x) for x in inodes.values()])
+
+        results = {'good': 0, 'short': 0, 'corrupt': 0}
+        if not self.verify_pool:
+            self.verify_pool = multiprocessing.Pool(multiprocessing.cpu_count())  # NOQA
+        try:
+            for first_path, size, digest in self.verify_pool.imap_unordered(digest_file, sorted(links)):  # NOQA
+                for path in links[first_path]:
+                    loop = paths[path]
+                    record = self.state.record(path)
+                    if size is None or (loop.pkg_size is not None and size > loop.pkg_size):  # NOQA
+                        result = 'corrupt'
+                    elif loop.pkg_size is not None and size < loop.pkg_size:
+                        result = 'short'
+                    elif record and record['digest'] and record['digest'] != digest:  # NOQA
+                        result = 'corrupt'
+                    else:
+                        result = 'good'
+                    results[result] += 1
+                    self.report.count('verify', result)
+
+                    if result == 'good':
+                        if not self.dry_run and not (record and record['digest']):  # NOQA
+                            self.state.completed(path, loop.pkg_name, loop.pkg_url, loop.pkg_size, digest)  # NOQA
+                        continue
+
+                    if not self.quiet_mode:
+                        self.printlog('%s: %s (%s of %s bytes)' % (result.capitalize(), path, size, loop.pkg_size))  # NOQA
+                    if self.dry_run:
+                        continue
+                    if result == 'short':
+                        # Marked as started, so the download resumes
+                        self.state.started(path, loop.pkg_name, loop.pkg_url, loop.pkg_size)  # NOQA
+                    else:
+                        if os.path.exists(path):
+                            os.remove(path)
+                        self.state.forget(path)
+        except BaseException:
+            # Files still queued aren't worth hashing for a failed run
+            self.verify_pool.terminate()
+            self.verify_pool.join()
+            self.verify_pool = None
+            raise
+
+        if not self.quiet_mode:
+            self.printlog('Verified %s packages: %s good, %s short, %s corrupt' % (len(paths), results['good'], results['short'], results['corrupt']))  # NOQA
+
+    def file_state(self, path, pkg):
+        '''Returns 'complete' if path holds the whole package, 'partial' if
+        it was left by a download that didn't finish, or 'stale' if it has
+        changed since it was downloaded. Files from before the state database
+        are taken as complete if they are the expected size.'''
+        record = self.state.record(path)
+        size = os.path.getsize(path)
+        if record is None:
+            if size < pkg.pkg_size:
+                return 'partial'
+            if size == pkg.pkg_size and not self.dry_run:
+                self.state.completed(path, pkg.pkg_name, pkg.pkg_url, pkg.pkg_size)  # NOQA
+            return 'complete'
+        elif not record['completed']:
+            return 'partial'
+        elif record['verified_size'] != size:
+            return 'stale'
+        return 'complete'
+
+    def resume(self, pkg, path, download_log_msg):
+        '''Queues the rest of an interrupted download of the package.'''
+        self.report.count('packages', 'resumed')
+        if self.dry_run:
+            if not self.quiet_mode:
+                self.printlog('Resume: %s' % download_log_msg)
+        else:
+            if not self.quiet_mode:
+                self.printlog('Resuming: %s' % download_log_msg)
+            self.queue_download(pkg, path)
+
+    def queue_download(self, pkg, destination):
+        '''Submits the package to the download engine, saving to destination,
+        and accounts for its size against the free space.'''
+        self.report.count('packages', 'downloads_queued')
+
+        def callback(url, destination, error, digest):
+            if pkg.pkg_mandatory:
+                with self.mandatory_condition:
+                    self.mandatory_pending = self.mandatory_pending - 1
+                    if error:
+                        self.mandatory_failed = self.mandatory_failed + 1
+                    else:
+                        self.mandatory_landed = self.mandatory_landed + 1
+                    self.mandatory_condition.notify_all()
+
+            if error:
+                # The cached size may be out of date, so check it next run
+                if isinstance(error, SizeError):
+                    self.metadata.forget(url)
+                self.free_space.release(pkg.pkg_size)
+                with self.lock:
+                    self.failed_downloads.append(destination)
+                self.printlog('Download failed: %s' % pkg.pkg_name)  # NOQA
+                self.log.debug('Exception: %s' % error)
+            else:
+                self.free_space.commit(pkg.pkg_size)
+                if self.state:
+                    self.state.completed(destination, pkg.pkg_name, pkg.pkg_url, pkg.pkg_size, digest)  # NOQA
+                if self.mirror_index and destination == pkg.pkg_destination:  # NOQA
+                    self.mirror_index.landed(destination, digest)
+                self.download_complete(pkg)
+
+        if self.state:
+            self.state.started(destination, pkg.pkg_name, pkg.pkg_url, pkg.pkg_size)  # NOQA
+        if pkg.pkg_mandatory:
+            with self.lock:
+                self.mandatory_pending = self.mandatory_pending + 1
+        self.free_space.reserve(pkg.pkg_size)
+        self.downloads.submit(pkg.pkg_url, destination, callback=callback, size=pkg.pkg_size)  # NOQA
+
+    def download_complete(self, pkg):
+        '''Updates the summary and found files once a package has downloaded.
+        This can be called from a download worker thread.'''
+        with self.lock:
+            # Update summary report
+            self.deployment_summary['downloaded_amount'] = self.deployment_summary['downloaded_amount'] + (pkg.pkg_size or 0)  # NOQA
+
+        # Add this to self.files_found so we can test on the next go around.  # NOQA
+        # Store downloads are added once linked to the destination.
+        if not self.deployment_mode and not self.store:
+            self.files_found.add(pkg.pkg_destination, pkg.pkg_size)
+
+        if not any([self.quiet_mode, self.muted_download, self.deployment_mode]):  # NOQA
+            self.printlog('Downloaded: %s' % pkg.pkg_name)
+
+    def finish_downloads(self):
+        '''Waits for queued downloads to finish, then copies or links any
+        duplicates of packages that were still downloading. Mandatory
+        packages were queued first, so they are waited for and linked first,
+        before waiting for the optional packages.'''
+        if not self.deployment_mode:
+            with self.report.phase('download_wait'):
+                with self.mandatory_condition:
+                    while self.mandatory_pending:
+                        # Wait with a timeout so a KeyboardInterrupt isn't blocked  # NOQA
+                        self.mandatory_condition.wait(1)
+            self.link_pkgs(mandatory=True)
+            self.mandatory_complete()
+
+        with self.report.phase('download_wait'):
+            self.downloads.join()
+        self.link_pkgs()
+
+        if self.mirror_index:
+            self.mirror_index.save(force=True)
+        self.failed_downloads = []
+        self.in_flight = {}
+
+        if self.store and sum(self.store.stats.values()) and not self.quiet_mode:  # NOQA
+            self.printlog('Linked packages from store %s: %s hard links, %s clones, %s copies' % (self.store.path, self.store.stats['hard_link'], self.store.stats['clone'], self.store.stats['copy']))  # NOQA
+
+        if self.downloads.stats['files'] and not self.quiet_mode:
+            self.printlog('Downloaded %s packages, %s at %s/s' % (self.downloads.stats['files'], self.convert_size(self.downloads.stats['bytes']), self.convert_size(self.downloads.throughput())))  # NOQA
+
+        if self.downloads.stats['failed']:
+            self.printlog('Failed downloads: %s' % ', '.join([os.path.basename(x) for x in self.downloads.stats['failed']]))  # NOQA
+
+    def link_pkgs(self, mandatory=False):
+        '''Copies or links the duplicates of packages that were downloading,
+        and links package destinations to the store, only for mandatory
+        packages if mandatory is True.'''
+        deferred = [x for x in self.deferred_duplicates if x[1].pkg_mandatory or not mandatory]  # NOQA
+        self.deferred_duplicates = [x for x in self.deferred_duplicates if not x[1].pkg_mandatory and mandatory]  # NOQA
+        links = [x for x in self.store_links if x[1].pkg_mandatory or not mandatory]  # NOQA
+        self.store_links = [x for x in self.store_links if not x[1].pkg_mandatory and mandatory]  # NOQA
+
+        for source_file, pkg in deferred:
+            if source_file not in self.failed_downloads:
+                self.copy_duplicate(source_file, pkg)
+
+        if links and not self.dry_run:
+            self.materialize_store(links)
+
+        # Copies and links land without a download
+        if self.mirror_index:
+            self.mirror_index.sweep()
+
+    def materialize_store(self, links):
+        '''Links planned package destinations to their files in the store, in
+        a single pass once the downloads have finished.'''
+        with self.report.phase('materialize'):
+            for store_file, pkg in links:
+                if store_file in self.failed_downloads or not os.path.exists(store_file):  # NOQA
+                    continue
+                if os.path.exists(pkg.pkg_destination):
+                    continue
+                try:
+                    method = self.store.materialize(store_file, pkg.pkg_destination)  # NOQA
+                    self.log.debug('Materialized %s from store (%s)' % (pkg.pkg_destination, method))  # NOQA
+                    self.files_found.add(pkg.pkg_destination, pkg.pkg_size)
+                    self.state.completed(pkg.pkg_destination, pkg.pkg_name, pkg.pkg_url, pkg.pkg_size, self.state.digest(store_file))  # NOQA
+                    self.landed(pkg)
+                except Exception as e:
+                    self.printlog('Unable to link %s from store: %s' % (pkg.pkg_name, e))  # NOQA
+
     def percentage(self, percentage, value):
         '''Returns the calculated percentage of the provided value'''
         if percentage < 100:
@@ -1046,76 +3991,80 @@ class AppleLoops():
 
     def convert_size(self, file_size, precision=2):
         '''Converts the package file size into a human readable number.'''
-        try:
-            suffixes = ['B', 'KB', 'MB', 'GB', 'TB']
-            suffix_index = 0
-            while file_size > 1024 and suffix_index < 4:
-                suffix_index += 1
-                file_size = file_size / 1024.0
-
-            return '%.*f %s' % (precision, file_size, suffixes[suffix_index])  # NOQA
-        except Exception:
-            # Yes, an exception can occur, but ignore it
-            pass
+        return convert_size(file_size, precision)
 
     def duplicate_file_exists(self, pkg):
         '''Simple test to see if a duplicate file exists elsewhere.
         This uses exceptions to indicate an item needs to be downloaded.'''
         # Don't need to check if in deployment mode, all files downloaded anyway  # NOQA
         if not self.deployment_mode:
-            if len(self.files_found) > 0:
-                for source_file in self.files_found:
-                    if pkg.pkg_name in os.path.basename(source_file):  # NOQA
-                        if self.dry_run:
-                            if self.hard_link:
-                                self.printlog('Hard link existing file: %s' % pkg.pkg_name)  # NOQA
-                            else:
-                                self.printlog('Copy existing file: %s' % pkg.pkg_name)  # NOQA
-
-                        # If not a dry run, do the thing
-                        if not self.dry_run:
-                            if not os.path.exists(pkg.pkg_destination):
-                                # Make destination folder if it doesn't exist
-                                try:
-                                    if not os.path.exists(os.path.dirname(pkg.pkg_destination)):  # NOQA
-                                        os.makedirs(os.path.dirname(pkg.pkg_destination))  # NOQA
-                                        self.log.debug('Created %s to store packages.' % os.path.dirname(pkg.pkg_destination))  # NOQA
-                                except Exception as e:
-                                    self.log.debug('Exception: %s' % e)
-                                    self.exit('general_exception', custom_msg=e)  # NOQA
-
-                                # Try to hard link or copy the file
-                                if self.hard_link:
-                                    try:
-                                        # Create a hard link to save space
-                                        os.link(source_file, pkg.pkg_destination)  # NOQA
-                                        if not self.quiet_mode:
-                                            self.printlog('Hard link existing file: %s' % pkg.pkg_name)  # NOQA
-                                    except Exception as e:
-                                        self.exit('general_exception', custom_msg=e)  # NOQA
-                                else:
-                                    try:
-                                        shutil.copy2(source_file, pkg.pkg_destination)  # NOQA
-                                        if not self.quiet_mode:
-                                            self.printlog('Copied existing file: %s' % pkg.pkg_name)  # NOQA
-                                    except Exception as e:
-                                        self.exit('general_exception', custom_msg=e)  # NOQA
-                    # Be explicit about not matching any item in self.files_found here, otherwise excessive downloads  # NOQA
-                    elif not any(x.endswith(pkg.pkg_name) for x in self.files_found):  # NOQA
-                        # Raise exception if the file doesn't match any files discovered in self.found_files  # NOQA
-                        # Don't need to exit on this exception because this is a trigger for downloading  # NOQA
-                        self.log.debug('%s does not exist in found files.' % pkg.pkg_name)  # NOQA
-                        raise Exception('%s does not exist in found files.' % pkg.pkg_name)  # NOQA
+            # Completed downloads are an indexed lookup, the destination is
+            # only walked for files the state database doesn't know about.
+            source_file = self.state.find(pkg.pkg_name, pkg.pkg_size, within=self.destination) or self.files_found.find(pkg.pkg_name, pkg.pkg_size)  # NOQA
+            if source_file:
+                if self.dry_run:
+                    if self.hard_link:
+                        self.printlog('Hard link existing file: %s' % pkg.pkg_name)  # NOQA
+                    else:
+                        self.printlog('Copy existing file: %s' % pkg.pkg_name)  # NOQA
+
+                # If not a dry run, do the thing
+                if not self.dry_run:
+                    self.copy_duplicate(source_file, pkg)
             else:
+                # Raise exception if the file doesn't match any files discovered in self.found_files  # NOQA
+                # Don't need to exit on this exception because this is a trigger for downloading  # NOQA
                 error_msg = 'Loop %s not found in download path, assuming not downloaded.' % pkg.pkg_name  # NOQA
                 self.log.debug(error_msg)
-                # Don't need to exit on this exception because this is a trigger for downloading  # NOQA
                 raise Exception(error_msg)
         elif self.deployment_mode:
             # Still need to raise an exception to trigger a download
             # Don't need to exit on this exception because this is a trigger for downloading  # NOQA
             raise Exception('Deployment mode download')
 
+    def landed(self, pkg):
+        '''Counts a package downloaded, copied or linked to its destination
+        this run, outside of the download callbacks.'''
+        if pkg.pkg_mandatory:
+            with self.lock:
+                self.mandatory_landed = self.mandatory_landed + 1
+
+    def copy_duplicate(self, source_file, pkg):
+        '''Hard links or copies an existing file to the package destination.'''  # NOQA
+        if not os.path.exists(pkg.pkg_destination):
+            # Make destination folder if it doesn't exist
+            try:
+                if not os.path.exists(os.path.dirname(pkg.pkg_destination)):  # NOQA
+                    os.makedirs(os.path.dirname(pkg.pkg_destination))  # NOQA
+                    self.log.debug('Created %s to store packages.' % os.path.dirname(pkg.pkg_destination))  # NOQA
+            except Exception as e:
+                self.log.debug('Exception: %s' % e)
+                self.exit('general_exception', custom_msg=e)  # NOQA
+
+            # Try to hard link or copy the file
+            if self.hard_link:
+                try:
+                    # Create a hard link to save space
+                    os.link(source_file, pkg.pkg_destination)  # NOQA
+                    self.report.count('packages', 'hard_linked')
+                    if not self.quiet_mode:
+                        self.printlog('Hard link existing file: %s' % pkg.pkg_name)  # NOQA
+                except Exception as e:
+                    self.exit('general_exception', custom_msg=e)  # NOQA
+            else:
+                try:
+                    shutil.copy2(source_file, pkg.pkg_destination)  # NOQA
+                    self.report.count('packages', 'copied')
+                    if not self.quiet_mode:
+                        self.printlog('Copied existing file: %s' % pkg.pkg_name)  # NOQA
+                except Exception as e:
+                    self.exit('general_exception', custom_msg=e)  # NOQA
+
+            self.files_found.add(pkg.pkg_destination, pkg.pkg_size)
+            if self.state:
+                self.state.completed(pkg.pkg_destination, pkg.pkg_name, pkg.pkg_url, pkg.pkg_size, self.state.digest(source_file))  # NOQA
+            self.landed(pkg)
+
     def install_pkg(self, pkg, target=None):
         '''Installs the package onto the system when used in deployment mode.
         Attempts to install then delete the downloaded package.'''
@@ -1169,7 +4118,9 @@ class AppleLoops():
                 else:
                     self.printlog('  Installing: %s' % pkg.pkg_name)
 
-                (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
+                self.report.count('subprocess', os.path.basename(cmd[0]))
+                with self.report.phase('installs'):
+                    (result, error) = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()  # NOQA
 
                 if 'successful' in result:
                     self.printlog('  Installed: %s' % pkg.pkg_name)
@@ -1218,14 +4169,18 @@ class AppleLoops():
                 if not self.quiet_mode:
                     self.printlog('Building %s' % dmg_filename)
 
-                subprocess.check_call(cmd)
+                self.report.count('subprocess', os.path.basename(cmd[0]))
+                with self.report.phase('dmg'):
+                    subprocess.check_call(cmd)
             else:
                 if self.force_dmg:
                     try:
                         self.printlog('Removing DMG %s' % dmg_filename)
                         self.printlog('Building %s' % dmg_filename)
                         os.remove(dmg_filename)
-                        subprocess.check_call(cmd)
+                        self.report.count('subprocess', os.path.basename(cmd[0]))  # NOQA
+                        with self.report.phase('dmg'):
+                            subprocess.check_call(cmd)
                     except Exception:
                         self.exit('remove_dmg', custom_msg=dmg_filename)
                 else:
@@ -1270,9 +4225,16 @@ def main():
         def _get_default_metavar_for_optional(self, action):
             return action.dest.upper()
 
+    # Supported plists for the help text come from a cached or bundled copy
+    # of the configuration, so parsing arguments never waits on the network.
+    _config_path, _configuration = local_configuration()
+    if _configuration:
+        _supported_plists = supported_plists(_configuration)
+    else:
+        _supported_plists = '<plist>'
+
     parser = argparse.ArgumentParser(formatter_class=SaneUsageFormat)
     modes_exclusive_group = parser.add_mutually_exclusive_group()
-    server_exclusive_group = parser.add_mutually_exclusive_group()
 
     modes_exclusive_group.add_argument(
         '--apps',
@@ -1288,7 +4250,7 @@ def main():
         '--allow-insecure',
         action='store_true',
         dest='allow_insecure',
-        help='Uses --insecure flag for curl for https.',
+        help='Skips certificate verification for https.',
         required=False
     )
 
@@ -1310,13 +4272,23 @@ def main():
         required=False
     )
 
-    server_exclusive_group.add_argument(
+    parser.add_argument(
         '-c', '--cache-server',
         type=str,
-        nargs=1,
+        nargs='+',
         dest='cache_server',
         metavar='http://example.org:port',
-        help='Use cache server to download content through',
+        help='Use cache servers to download content through. Servers are ranked by latency and throughput, falling back to Apple servers.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--cache-path',
+        type=str,
+        nargs=1,
+        dest='cache_path',
+        metavar='<folder>',
+        help='Folder to keep cached loop feeds, package metadata, sync manifests and the download state database (state.db) in.',  # NOQA
         required=False
     )
 
@@ -1370,6 +4342,14 @@ def main():
         required=False
     )
 
+    parser.add_argument(
+        '--list-incomplete',
+        action='store_true',
+        dest='list_incomplete',
+        help='Lists packages with downloads that did not finish, then exits.',  # NOQA
+        required=False
+    )
+
     parser.add_argument(
         '--log-path',
         type=str,
@@ -1388,6 +4368,26 @@ def main():
         required=False
     )
 
+    parser.add_argument(
+        '--max-rate',
+        type=str,
+        nargs=1,
+        dest='max_rate',
+        metavar='<rate>',
+        help='Limit the combined download rate, in bytes per second with an optional K, M or G suffix, i.e. 20M.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--metadata-ttl',
+        type=int,
+        nargs=1,
+        dest='metadata_ttl',
+        metavar='<days>',
+        help='Days to trust cached package sizes before checking again. Default is 7.',  # NOQA
+        required=False
+    )
+
     parser.add_argument(
         '--mirror-paths',
         action='store_true',
@@ -1400,7 +4400,7 @@ def main():
         '--mute-progress-bar',
         action='store_true',
         dest='muted_download',
-        help='Disable the download progress bar',
+        help='Disable per package download progress output',
         required=False
     )
 
@@ -1420,13 +4420,33 @@ def main():
         required=False
     )
 
-    server_exclusive_group.add_argument(
-        '--pkg-server',
+    parser.add_argument(
+        '--port',
+        type=int,
+        nargs=1,
+        dest='port',
+        metavar='<port>',
+        help='Port for --serve to listen on. Default is 8080.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--order',
         type=str,
         nargs=1,
+        dest='order',
+        choices=['smallest', 'largest', 'feed'],
+        help='Order to download packages in, after mandatory before optional. Default is smallest.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--pkg-server',
+        type=str,
+        nargs='+',
         dest='pkg_server',
         metavar='http://example.org/path_to/loops',
-        help='Specify http server where loops are stored in your local environment.',  # NOQA
+        help='Specify http servers where loops are stored in your local environment. Servers are ranked by latency and throughput, falling back to Apple servers.',  # NOQA
         required=False
     )
 
@@ -1435,11 +4455,109 @@ def main():
         type=str,
         nargs='+',
         dest='plists',
-        metavar=AppleLoops(help_init=True).supported_plists,
+        metavar=_supported_plists,
         help='Processes all loops in specified plists.',
         required=False
     )
 
+    parser.add_argument(
+        '--download-workers',
+        type=int,
+        nargs=1,
+        dest='download_workers',
+        metavar='<number>',
+        help='Number of packages to download at once. Default is 4.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--host-connections',
+        type=int,
+        nargs=1,
+        dest='host_connections',
+        metavar='<number>',
+        help='Maximum downloads at once from any one server. Default is 4.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--probe-workers',
+        type=int,
+        nargs=1,
+        dest='probe_workers',
+        metavar='<number>',
+        help='Number of package size/mirror checks to run at once. Default is 8.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--rate-window',
+        type=str,
+        nargs='+',
+        dest='rate_windows',
+        metavar='<HH:MM-HH:MM=rate>',
+        help='Use a different rate limit between these times of day, 0 is unlimited, i.e. 18:00-07:00=0',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--refresh-metadata',
+        action='store_true',
+        dest='refresh_metadata',
+        help='Ignore cached package sizes and check every package.',
+        required=False
+    )
+
+    parser.add_argument(
+        '--report-json',
+        type=str,
+        nargs=1,
+        dest='report_json',
+        metavar='<path>',
+        help='File to write the run report to. Default is appleLoops_report.json in the log folder.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--serve',
+        type=str,
+        nargs=1,
+        dest='serve',
+        metavar='<folder>',
+        help='Serve a --mirror-paths destination over HTTP for --pkg-server clients, until interrupted.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--segments',
+        type=int,
+        nargs=1,
+        dest='download_segments',
+        metavar='<number>',
+        help='Byte ranges to download at once for large packages. Default is 4.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--segment-threshold',
+        type=int,
+        nargs=1,
+        dest='segment_threshold',
+        metavar='<MB>',
+        help='Package size to start downloading in segments from. Default is 64.',  # NOQA
+        required=False
+    )
+
+    parser.add_argument(
+        '--store',
+        type=str,
+        nargs=1,
+        dest='store_path',
+        metavar='<folder>',
+        help='Keep one copy of each package in this folder, and hard link packages in the destination to it.',  # NOQA
+        required=False
+    )
+
     parser.add_argument(
         '-t', '--threshold',
         type=int,
@@ -1458,6 +4576,14 @@ def main():
         required=False
     )
 
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        dest='verify',
+        help='Check packages already downloaded, and download any that are short or corrupt.',  # NOQA
+        required=False
+    )
+
     parser.add_argument(
         '-v', '--version',
         action='store_true',
@@ -1499,10 +4625,31 @@ def main():
             _force_dmg = False
 
         if args.cache_server:  # NOQA
-            _cache_server = args.cache_server[0]
+            _cache_server = args.cache_server
         else:
             _cache_server = None
 
+        if args.cache_path:
+            _cache_path = args.cache_path[0]
+        else:
+            _cache_path = None
+
+        if args.list_incomplete:
+            # Only reads the download state, there's nothing to list if no
+            # run has made it yet
+            state_path = os.path.join(cache_folder(_cache_path, args.deployment), 'state.db')  # NOQA
+            if not os.path.exists(state_path):
+                sys.exit(0)
+            state = StateDB(state_path, read_only=True)
+            for record in state.incomplete():
+                if os.path.exists(record['path']):
+                    on_disk = os.path.getsize(record['path'])
+                else:
+                    on_disk = 0
+                print '%s (%s of %s bytes, started %s)' % (record['path'], on_disk, record['expected_size'], time.strftime('%Y-%m-%d %H:%M', time.localtime(record['started'])))  # NOQA
+                print '    %s' % record['url']
+            sys.exit(0)
+
         if args.destination:
             _destination = args.destination[0]
         else:
@@ -1533,6 +4680,11 @@ def main():
         else:
             _log_path = False
 
+        if args.metadata_ttl:
+            _metadata_ttl = args.metadata_ttl[0]
+        else:
+            _metadata_ttl = 7
+
         if args.mirror:
             _mirror = True
         else:
@@ -1554,10 +4706,79 @@ def main():
             _optional = False
 
         if args.pkg_server:  # NOQA
-            _pkg_server = args.pkg_server[0]
+            _pkg_server = args.pkg_server
         else:
             _pkg_server = False
 
+        if args.download_workers:
+            _download_workers = args.download_workers[0]
+        else:
+            _download_workers = 4
+
+        if args.host_connections:
+            _host_connections = args.host_connections[0]
+        else:
+            _host_connections = 4
+
+        if args.probe_workers:
+            _probe_workers = args.probe_workers[0]
+        else:
+            _probe_workers = 8
+
+        if args.refresh_metadata:
+            _refresh_metadata = True
+        else:
+            _refresh_metadata = False
+
+        if args.report_json:
+            _report_json = args.report_json[0]
+        else:
+            _report_json = None
+
+        if args.download_segments:
+            _download_segments = args.download_segments[0]
+        else:
+            _download_segments = 4
+
+        if args.segment_threshold:
+            _segment_threshold = args.segment_threshold[0]
+        else:
+            _segment_threshold = 64
+
+        if args.store_path:
+            _store_path = args.store_path[0]
+        else:
+            _store_path = None
+
+        if args.verify:
+            _verify = True
+        else:
+            _verify = False
+
+        if args.max_rate:
+            try:
+                parse_rate(args.max_rate[0])
+            except ValueError as e:
+                parser.error(str(e))
+            _max_rate = args.max_rate[0]
+        else:
+            _max_rate = None
+
+        if args.rate_windows:
+            for window in args.rate_windows:
+                try:
+                    parse_rate_window(window)
+                except ValueError as e:
+                    parser.error(str(e))
+            _rate_windows = args.rate_windows
+        else:
+            _rate_windows = None
+
+        if args.order:
+            _order = args.order[0]
+        else:
+            _order = 'smallest'
+
         if args.threshold:
             _space_threshold = args.threshold[0]
         else:
@@ -1582,17 +4803,37 @@ def main():
         else:
             _hard_link = False
 
+        if args.serve:
+            if args.port:
+                _port = args.port[0]
+            else:
+                _port = 8080
+
+            log = logging.getLogger('appleLoops')
+            log.setLevel(logging.DEBUG if _debug else logging.INFO)
+            fh = RotatingFileHandler(os.path.join(os.path.expanduser(os.path.expandvars(_log_path or '~/Library/Logs')), 'appleLoops.log'), maxBytes=(1048576*5), backupCount=7)  # NOQA
+            fh.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))  # NOQA
+            log.addHandler(fh)
+
+            MirrorServer(os.path.expanduser(os.path.expandvars(args.serve[0])), ('', _port), quiet_mode=_quiet).run()  # NOQA
+            sys.exit(0)
+
         al = AppleLoops(allow_insecure=_allow_insecure, allow_untrusted=_allow_untrusted, apps=_apps, apps_plist=_plists,  # NOQA
                         caching_server=_cache_server, debug=_debug, deployment_mode=_deployment,  # NOQA
                         destination=_destination, dmg_filename=_dmg_filename, dry_run=_dry_run,  # NOQA
                         force_deploy=_force_deploy, force_dmg=_force_dmg, hard_link=_hard_link, help_init=False,  # NOQA
                         log_path=_log_path, mandatory_loops=_mandatory, mirror_paths=_mirror,  # NOQA
                         muted_download=_muted_download, optional_loops=_optional, pkg_server=_pkg_server,  # NOQA
-                        quiet_mode=_quiet, space_threshold=_space_threshold)  # NOQA
+                        probe_workers=_probe_workers, quiet_mode=_quiet, space_threshold=_space_threshold,  # NOQA
+                        download_workers=_download_workers, host_connections=_host_connections,  # NOQA
+                        cache_path=_cache_path, metadata_ttl=_metadata_ttl, refresh_metadata=_refresh_metadata,  # NOQA
+                        report_json=_report_json, download_segments=_download_segments,  # NOQA
+                        segment_threshold=_segment_threshold, store_path=_store_path,  # NOQA
+                        verify=_verify, max_rate=_max_rate, rate_windows=_rate_windows,  # NOQA
+                        order=_order)
 
         al.main_processor()
     else:
-        al = AppleLoops(help_init=True)
         parser.print_help()
         sys.exit(0)
 
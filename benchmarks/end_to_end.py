@@ -0,0 +1,334 @@
+#!/usr/bin/python
+
+'''
+End to end benchmark of appleLoops.py against a local stand-in for Apple's
+content servers.
+
+A local HTTP server serves the configuration and the feeds bundled in this
+repo, plus synthetic packages for every package the feeds list. Packages are
+runs of zero bytes generated on the fly, so nothing large is kept on disk
+by the server. Latency (per request) and bandwidth (per response) can be
+set to mimic a real network.
+
+Each scenario runs AppleLoops.main_processor() against a fresh destination
+and cache, and records the wall time, requests and bytes served, HTTP
+connections opened, subprocesses spawned, and the time until the mandatory
+packages were usable. Results are written as JSON
+so runs can be compared between versions:
+
+    ./end_to_end.py --output before.json
+    ./end_to_end.py --output after.json --compare before.json
+'''
+
+import argparse
+import BaseHTTPServer
+import hashlib
+import inspect
+import json
+import os
+import re
+import shutil
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import appleLoops  # NOQA
+
+SCENARIOS = ['dry_run', 'download', 'download_rerun', 'mirror_paths']
+CHUNK = 65536
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0, bandwidth=0, min_size=32768, max_size=262144):  # NOQA
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.min_size = min_size
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {
+                'requests': 0,
+                'requests_by_method': {},
+                'bytes_sent': 0,
+            }
+
+    def count(self, method, sent=0):
+        with self.lock:
+            if method:
+                self.stats['requests'] += 1
+                self.stats['requests_by_method'][method] = self.stats['requests_by_method'].get(method, 0) + 1  # NOQA
+            self.stats['bytes_sent'] += sent
+
+    def pkg_size(self, path):
+        '''Synthetic packages get a stable size between min_size and
+        max_size, derived from their path.'''
+        spread = self.max_size - self.min_size
+        return self.min_size + int(hashlib.sha1(path).hexdigest()[:8], 16) % (spread + 1)  # NOQA
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def respond(self, body):
+        self.server.count(self.command)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        path = self.path.split('?')[0]
+        if path.endswith('.pkg'):
+            size = self.server.pkg_size(path)
+            data = None
+        elif path.endswith('.plist'):
+            local_path = os.path.join(ROOT, path.lstrip('/'))
+            if '..' in path or not os.path.isfile(local_path):
+                return self.not_found()
+            with open(local_path, 'rb') as f:
+                data = f.read()
+            size = len(data)
+        else:
+            return self.not_found()
+
+        etag = '"%s"' % hashlib.sha1('%s:%s' % (path, size)).hexdigest()[:16]  # NOQA
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))  # NOQA
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), size - 1)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%s' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, size))  # NOQA
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        if body:
+            self.send_body(data, start, end + 1)
+
+    def send_body(self, data, start, end):
+        began = time.time()
+        sent = 0
+        while start + sent < end:
+            length = min(CHUNK, end - start - sent)
+            if data is None:
+                chunk = '\0' * length
+            else:
+                chunk = data[start + sent:start + sent + length]
+            self.wfile.write(chunk)
+            sent += length
+            self.server.count(None, length)
+
+            # Throttle to the configured bandwidth for this response
+            if self.server.bandwidth:
+                ahead = sent / float(self.server.bandwidth) - (time.time() - began)  # NOQA
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    def not_found(self):
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class CountingPopen(subprocess.Popen):
+    '''Counts every subprocess appleLoops.py starts, including those started
+    by subprocess.call and check_call.'''
+    spawned = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingPopen.spawned += 1
+        subprocess.Popen.__init__(self, *args, **kwargs)
+
+
+def supported_kwargs(**kwargs):
+    '''Returns the keyword arguments that this version of AppleLoops takes,
+    so older versions can be benchmarked with the same scenarios. Settings
+    a version doesn't have are left at its own behaviour.'''
+    accepted = inspect.getargspec(appleLoops.AppleLoops.__init__).args
+    skipped = sorted([x for x in kwargs if x not in accepted])
+    if skipped:
+        sys.stderr.write('AppleLoops does not take %s, skipping\n' % ', '.join(skipped))  # NOQA
+    return dict([(x, kwargs[x]) for x in kwargs if x in accepted])
+
+
+def run_scenario(server, scenario, plists, workdir, settings):
+    '''Runs one scenario and returns its measurements.'''
+    destination = os.path.join(workdir, 'loops')
+    cache_path = os.path.join(workdir, 'cache')
+
+    if scenario != 'download_rerun':
+        for path in [destination, cache_path]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        os.makedirs(destination)
+
+    server.reset()
+    CountingPopen.spawned = 0
+    stdout = sys.stdout
+    start = time.time()
+    try:
+        # Quieten the per package output while timing
+        sys.stdout = open(os.devnull, 'w')
+        al = appleLoops.AppleLoops(**supported_kwargs(
+            apps_plist=plists, destination=destination,
+            dry_run=(scenario == 'dry_run'),
+            log_path=workdir, cache_path=cache_path,
+            mandatory_loops=True, optional_loops=True,
+            mirror_paths=(scenario == 'mirror_paths'),
+            muted_download=True, pkg_server=server.url,
+            probe_workers=settings['probe_workers'],
+            download_workers=settings['download_workers'],
+            download_segments=settings['segments'],
+            segment_threshold=settings['segment_threshold'],
+            order=settings['order']))
+        # Feeds and packages come from the local server, not Apple
+        al.base_url = '%s/lp10_ms3_content_' % server.url
+        al.main_processor()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    wall_time = time.time() - start
+
+    files = 0
+    for root, dirs, names in os.walk(destination):
+        files += len([x for x in names if x.endswith('.pkg')])
+
+    return {
+        'wall_time': round(wall_time, 3),
+        'requests': server.stats['requests'],
+        'requests_by_method': server.stats['requests_by_method'],
+        'bytes_sent': server.stats['bytes_sent'],
+        'connections_opened': getattr(al.request, 'stats', {}).get('connections_opened'),  # NOQA
+        'subprocess_spawns': CountingPopen.spawned,
+        'usable_seconds': getattr(al, 'usable_seconds', None),
+        'packages_on_disk': files,
+    }
+
+
+def compare(results, baseline_path):
+    '''Prints the change in each measurement from a previous results file.'''
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    print 'Compared with %s (version %s)' % (baseline_path, baseline.get('version'))  # NOQA
+    if baseline.get('settings') != results['settings']:
+        print '  Warning: settings differ, results may not be comparable'
+    for scenario in SCENARIOS:
+        old = baseline['scenarios'].get(scenario)
+        new = results['scenarios'].get(scenario)
+        if not old or not new:
+            continue
+        for key in ['wall_time', 'usable_seconds', 'requests', 'bytes_sent', 'connections_opened', 'subprocess_spawns']:  # NOQA
+            # Older results may not have every measurement
+            if old.get(key) != new[key]:
+                change = ''
+                if old.get(key) and new[key] is not None:
+                    change = ' (%+.1f%%)' % ((new[key] - old[key]) * 100.0 / old[key])  # NOQA
+                print '  %-16s %-20s %s -> %s%s' % (scenario, key, old.get(key), new[key], change)  # NOQA
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end benchmark of appleLoops.py')  # NOQA
+    parser.add_argument('--plists', nargs='+', default=['garageband1021.plist'], help='Feeds to process. Default is garageband1021.plist.')  # NOQA
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS, help='Scenarios to run. Default is all of them.')  # NOQA
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before each response. Default is 0.')  # NOQA
+    parser.add_argument('--bandwidth', type=int, default=0, help='Bytes per second per response. Default is unlimited.')  # NOQA
+    parser.add_argument('--min-size', type=int, default=32768, help='Smallest synthetic package in bytes.')  # NOQA
+    parser.add_argument('--max-size', type=int, default=262144, help='Largest synthetic package in bytes.')  # NOQA
+    parser.add_argument('--probe-workers', type=int, default=8)
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--segments', type=int, default=4)
+    parser.add_argument('--segment-threshold', type=int, default=64, help='Package size in MB to download in segments from.')  # NOQA
+    parser.add_argument('--order', choices=['smallest', 'largest', 'feed'], default='smallest', help='Order to download packages in. Default is smallest.')  # NOQA
+    parser.add_argument('--output', default='end_to_end.json', help='JSON file to write results to.')  # NOQA
+    parser.add_argument('--compare', metavar='<results.json>', help='Previous results to compare with.')  # NOQA
+    args = parser.parse_args()
+
+    settings = {
+        'plists': args.plists,
+        'latency': args.latency,
+        'bandwidth': args.bandwidth,
+        'min_size': args.min_size,
+        'max_size': args.max_size,
+        'probe_workers': args.probe_workers,
+        'download_workers': args.download_workers,
+        'segments': args.segments,
+        'segment_threshold': args.segment_threshold,
+        'order': args.order,
+    }
+
+    server = Server(latency=args.latency, bandwidth=args.bandwidth, min_size=args.min_size, max_size=args.max_size)  # NOQA
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    subprocess.Popen = CountingPopen
+    workdir = tempfile.mkdtemp(prefix='appleLoops_e2e_')
+    results = {
+        'version': appleLoops.__version__,
+        'python': sys.version.split()[0],
+        'timestamp': int(time.time()),
+        'settings': settings,
+        'scenarios': {},
+    }
+
+    try:
+        for scenario in args.scenarios:
+            results['scenarios'][scenario] = run_scenario(server, scenario, args.plists, workdir, settings)  # NOQA
+            print '%-16s %s' % (scenario, json.dumps(results['scenarios'][scenario], sort_keys=True))  # NOQA
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print 'Results written to %s' % args.output
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+'''
+Benchmarks reading loop feeds with the streaming FeedReader used by
+appleLoops.py against plistlib, which builds the whole feed in memory.
+
+Each feed and parser is run in its own process so peak memory (the growth in
+maximum resident set size while parsing) isn't shared between runs.
+
+Usage: ./feed_parser.py [feed.plist ...]
+Defaults to the feeds in lp10_ms3_content_2016.
+'''
+
+import os
+import plistlib
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from appleLoops import read_feed  # NOQA
+
+PARSERS = {
+    'plistlib': plistlib.readPlistFromString,
+    'read_feed': read_feed,
+}
+
+
+def max_rss():
+    '''Returns the peak resident set size of this process in KB.'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # macOS reports bytes, Linux reports KB
+        rss = rss / 1024
+    return rss
+
+
+def measure(parser, path):
+    '''Parses path with parser, printing the time taken and memory used.'''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    before = max_rss()
+    start = time.time()
+    feed = PARSERS[parser](data)
+    finish = time.time()
+    print '%s %s %s' % (finish - start, max_rss() - before, len(feed['Packages']))  # NOQA
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        measure(sys.argv[2], sys.argv[3])
+        return
+
+    feeds = sys.argv[1:] or sorted([os.path.join(ROOT, 'lp10_ms3_content_2016', x) for x in os.listdir(os.path.join(ROOT, 'lp10_ms3_content_2016')) if x.endswith('.plist')])  # NOQA
+
+    print '%-22s  %8s  %-10s  %8s  %10s  %12s' % ('feed', 'size (KB)', 'parser', 'packages', 'time (ms)', 'peak mem (KB)')  # NOQA
+    for feed in feeds:
+        for parser in sorted(PARSERS):
+            result = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--measure', parser, feed])  # NOQA
+            seconds, memory, packages = result.split()
+            print '%-22s  %8s  %-10s  %8s  %10.1f  %12s' % (os.path.basename(feed), os.path.getsize(feed) / 1024, parser, packages, float(seconds) * 1000, memory)  # NOQA
+
+
+if __name__ == '__main__':
+    main()
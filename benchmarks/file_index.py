@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+'''
+Benchmarks duplicate detection lookups against a synthetic destination tree.
+
+Compares the FileIndex used by appleLoops.py with the list scan it replaced,
+for destination trees of increasing size. FileIndex lookup cost should stay
+flat as the tree grows, while the list scan grows with the number of files.
+
+Usage: ./file_index.py [number of files ...]
+'''
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # NOQA
+
+from appleLoops import FileIndex  # NOQA
+
+LOOKUPS = 500
+
+
+def build_tree(path, count):
+    '''Creates count empty .pkg files spread over per-plist folders, the same
+    layout appleLoops.py uses without --mirror-paths.'''
+    names = []
+    for i in range(count):
+        folder = os.path.join(path, 'garageband%s' % (1000 + i % 20), ['mandatory', 'optional'][i % 2])  # NOQA
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        name = 'MAContent10_AssetPack_%05d.pkg' % i
+        open(os.path.join(folder, name), 'w').close()
+        names.append(name)
+    return names
+
+
+def list_scan(path, names):
+    '''The previous approach: build a list with a membership test for every
+    file, then scan the whole list for every lookup.'''
+    files_found = []
+    for root, dirs, files in os.walk(path, topdown=True):
+        for name in files:
+            if name.endswith('.pkg'):
+                _file = os.path.join(root, name)
+                if _file not in files_found:
+                    files_found.append(_file)
+    built = time.time()
+
+    for name in names:
+        for source_file in files_found:
+            if name in os.path.basename(source_file):
+                break
+    return built
+
+
+def file_index(path, names):
+    index = FileIndex(path)
+    index.build()
+    built = time.time()
+
+    for name in names:
+        index.find(name)
+    return built
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 5000, 20000]
+
+    print '%8s  %-10s  %12s  %14s' % ('files', 'method', 'build (s)', 'lookup (us)')  # NOQA
+    for size in sizes:
+        path = tempfile.mkdtemp(prefix='appleLoops_bench_')
+        try:
+            names = build_tree(path, size)
+            # Half the lookups hit, half miss
+            lookups = random.sample(names, LOOKUPS / 2)
+            lookups.extend(['Missing_%05d.pkg' % i for i in range(LOOKUPS / 2)])  # NOQA
+
+            for method in [list_scan, file_index]:
+                start = time.time()
+                built = method(path, lookups)
+                finish = time.time()
+                print '%8s  %-10s  %12.3f  %14.2f' % (size, method.__name__, built - start, (finish - built) * 1000000 / LOOKUPS)  # NOQA
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,14 @@ _appleLoops() {
   COMPREPLY=()
 
   cur="${COMP_WORDS[COMP_CWORD]}"
-  opts="--allow-insecure allow-untrusted --apps --build-dmg --cache-server --debug \
-    --destination --deployment --dry-run --force-deploy --hard-link --log-path \
-    --mandatory-only --mirror-paths --mute-progress-bar --optional-only \
-    --pkg-server --plists --threshold --quiet --version"
+  opts="--allow-insecure allow-untrusted --apps --build-dmg --cache-path \
+    --cache-server --debug \
+    --destination --deployment --download-workers --dry-run --force-deploy \
+    --hard-link --host-connections --list-incomplete --log-path \
+    --mandatory-only --max-rate --metadata-ttl --mirror-paths --mute-progress-bar \
+    --optional-only --order --rate-window --refresh-metadata --report-json \
+    --pkg-server --plists --port --probe-workers --serve --segments --segment-threshold --store \
+    --threshold --quiet --verify --version"
 
   case "$cur" in
     --*)